@@ -6,7 +6,7 @@ import time
 import bluetooth
 
 from cfg import BTPORT
-from utils import logger, usbtool
+from utils import logger, usbtool, frames
 
 if os.name == 'nt':
     raise SystemExit('This program is designed to run only on a Raspberry Device')
@@ -67,7 +67,7 @@ try:
                     # Send board data to client
                     try:
                         data = QUEUE_FROM_USBTOOL.get_nowait()
-                        client_sock.send(data.encode('utf-8'))
+                        client_sock.send(frames.format_frame(data))
                     except bluetooth.btcommon.BluetoothError as e:
                         print('Connection closed:', e)
                         break
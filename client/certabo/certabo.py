@@ -7,6 +7,7 @@
 import os
 import logging
 import logging.handlers
+import queue
 import threading
 
 import chess.pgn
@@ -19,7 +20,10 @@ sys.path.append(str(Path(__file__).parent))
 # certabo helpers
 import codes
 import serialreader
+from utils import frames, led_scheduler, led_animation
 from utils.usbtool import find_address
+from utils.move_queue import MoveQueue
+from utils.reader_writer import cells_to_fen
 
 CERTABO_DATA_PATH = r"certabo\utils\data"
 # TODO: Fix this, move it into certabo function
@@ -27,7 +31,7 @@ os.makedirs(CERTABO_DATA_PATH, exist_ok=True)
 
 
 class Certabo:
-    def __init__(self, calibrate=0, port=None, **kwargs):
+    def __init__(self, calibrate=0, port=None, history_depth=3, reading_filter=None, **kwargs):
         super().__init__(**kwargs)
         if port is None:
             self.portname = find_address()
@@ -49,17 +53,25 @@ class Certabo:
         self.board_state_usb = ""
         self.mystate = "init"
         self.reference = ""
-        self.move_event = threading.Event()
-        self.wait_for_move = False
-        self.pending_moves = []
+        # moves detected on the board, waiting to be played (see get_user_move)
+        self.move_queue = MoveQueue()
+        # held while chessboard and the pending moves are read together, or a move is played
+        self.board_lock = threading.RLock()
+        # led animations take over the leds from diff_leds while they run
+        self.animator = led_animation.LedAnimator(self.send_leds)
 
         # internal values for CERTABO board
         self.calibration_samples_counter = 0
         self.calibration_samples = []
-        self.usb_data_history_depth = 3
+        # Deeper histories reject more noise; cheap when numpy is available (see codes.statistic_processing)
+        self.usb_data_history_depth = history_depth
         self.usb_data_history = list(range(self.usb_data_history_depth))
         self.usb_data_history_filled = False
         self.usb_data_history_i = 0
+        # Optional debounce filter (see utils.reading_filter), used instead of the majority vote over the history
+        self.reading_filter = reading_filter
+        self.last_usb_data = None
+        self.usb_cells = [""] * 64
         self.move_detect_tries = 0
         self.move_detect_max_tries = 3
 
@@ -74,14 +86,39 @@ class Certabo:
         self.serialthread.daemon = True
         self.serialthread.start()
 
-    def get_user_move(self):
-        self.wait_for_move = True
-        logging.debug('waiting for event signal')
-        self.move_event.wait()
-        self.move_event.clear()
-        logging.debug(f'event signal received, pending moves: {self.pending_moves}')
-        self.wait_for_move = False
-        return self.pending_moves 
+    def get_user_move(self, timeout=None):
+        """
+        Returns the oldest move detected on the board (a list of uci moves), waiting up to timeout
+        seconds (forever if None). Returns [] if no move was made in time.
+        The move still counts for move detection until it is confirmed with play_user_move.
+        """
+        try:
+            detected = self.move_queue.get(timeout)
+        except queue.Empty:
+            return []
+        logging.debug(f'user move received: {detected.moves}')
+        return detected.moves
+
+    def play_user_move(self, move=None):
+        """
+        Pushes move (a chess.Move or uci string, None if the move was rejected) to chessboard and
+        confirms the move returned by get_user_move, in one step for move detection
+        """
+        with self.board_lock:
+            if move is not None:
+                self.push_move(move)
+            self.move_queue.task_done()
+
+    def push_move(self, move):
+        """
+        Plays a move (uci string or chess.Move) on the virtual board, e.g. the answer of an opponent.
+        Moves must not be pushed to chessboard directly, move detection reads it from the serial thread.
+        """
+        with self.board_lock:
+            if isinstance(move, str):
+                self.chessboard.push_uci(move)
+            else:
+                self.chessboard.push(move)
 
     def get_reference(self):
         return self.reference
@@ -102,17 +139,47 @@ class Certabo:
         return self.mystate
 
     def new_game(self):
-        self.chessboard = chess.Board()
+        with self.board_lock:
+            self.chessboard = chess.Board()
+            self.move_queue.clear()
         self.mystate = "init"
 
     def set_board_from_fen(self, fen):
-        self.chessboard = chess.Board(fen)
+        with self.board_lock:
+            self.chessboard = chess.Board(fen)
+            self.move_queue.clear()
+
+    def expected_board(self):
+        """
+        Returns the virtual board with the moves still waiting in the queue already played
+        """
+        with self.board_lock:
+            board = self.chessboard.copy(stack=False)
+            pending = self.move_queue.pending()
+        for moves in pending:
+            for move in moves:
+                try:
+                    board.push_uci(move)
+                except ValueError:
+                    logging.warning(f'queued move {move} is not legal in {board.fen()}')
+                    return board
+        return board
 
-    def send_leds(self, message:bytes=(0).to_bytes(8,byteorder='big',signed=False)):
+    def send_leds(self, message:bytes=(0).to_bytes(8,byteorder='big',signed=False), priority=led_scheduler.PRIORITY_NORMAL,
+                  replace=False):
         # logging.info(f'sending LED: {message}')
-        self.serialthread.send_led(message)
+        # the serial thread drops repeated frames, so this is cheap to call on every reading
+        self.serialthread.send_led(message, priority, replace)
+
+    def play_animation(self, animation, priority=led_scheduler.PRIORITY_NORMAL):
+        """
+        Plays a led animation (see utils.led_animation) without blocking, diff_leds resumes when it ends
+        """
+        self.animator.play(animation, priority)
 
     def diff_leds(self):
+        if self.animator.running:
+            return
         s1 = self.chessboard.board_fen()
         s2 = self.board_state_usb.split(" ")[0]
         if (s1 != s2):
@@ -122,42 +189,71 @@ class Certabo:
         else:
             self.send_leds()
 
-    def handle_usb_data(self, data):
-        usb_data = list(map(int, data.split(" ")))
+    def handle_usb_data(self, usb_data):
+        # usb_data is a 320 byte frame, see utils.frames
         if self.calibration == True:
             self.calibrate_from_usb_data(usb_data)
+            return
+
+        if self.reading_filter is not None:
+            test_state = self.filter_usb_data(usb_data)
         else:
-            if self.usb_data_history_i >= self.usb_data_history_depth:
-                self.usb_data_history_filled = True
-                self.usb_data_history_i = 0
-
-            self.usb_data_history[self.usb_data_history_i] = list(usb_data)[:]
-            self.usb_data_history_i += 1
-            if self.usb_data_history_filled:
-                self.usb_data_processed = codes.statistic_processing(self.usb_data_history, False)
-                if self.usb_data_processed != []:
-                    test_state = codes.usb_data_to_FEN(self.usb_data_processed, self.rotate180)
-                    # print(test_state)
-                    if test_state != "":
-                        if self.board_state_usb != test_state:
-                            new_position = True
-                        else:
-                            new_position = False
-                        self.board_state_usb = test_state
-                        self.diff_leds()
-                        if new_position:
-                            # new board state via usb
-                            # logging.info(f'info string FEN {test_state}')
-                            if self.wait_for_move:
-                                logging.debug('trying to find user move in usb data')
-                                try:
-                                    self.pending_moves = codes.get_moves(self.chessboard, self.board_state_usb, 1) # only search one move deep
-                                    if self.pending_moves != []:
-                                        logging.debug('firing event')
-                                        # self.chessboard.push_uci(self.pending_moves[0])
-                                        self.move_event.set()
-                                except:
-                                    self.pending_moves = []
+            test_state = self.vote_usb_data(usb_data)
+        # print(test_state)
+        if test_state:
+            if self.board_state_usb != test_state:
+                new_position = True
+            else:
+                new_position = False
+            self.board_state_usb = test_state
+            self.diff_leds()
+            if new_position:
+                # new board state via usb
+                # logging.info(f'info string FEN {test_state}')
+                # Moves are detected on top of the moves that were not played yet
+                logging.debug('trying to find user move in usb data')
+                try:
+                    moves = codes.get_moves(self.expected_board(), self.board_state_usb, 1) # only search one move deep
+                except codes.InvalidMove:
+                    moves = []
+                if moves:
+                    logging.debug(f'queueing user move {moves}')
+                    self.move_queue.put(moves)
+
+    def vote_usb_data(self, usb_data):
+        """
+        Majority vote over the last usb_data_history_depth readings, returns the FEN or "" if not available
+        """
+        if self.usb_data_history_i >= self.usb_data_history_depth:
+            self.usb_data_history_filled = True
+            self.usb_data_history_i = 0
+
+        self.usb_data_history[self.usb_data_history_i] = usb_data
+        self.usb_data_history_i += 1
+        if self.usb_data_history_filled:
+            self.usb_data_processed = codes.statistic_processing(self.usb_data_history, False)
+            if self.usb_data_processed != []:
+                return codes.usb_data_to_FEN(self.usb_data_processed, self.rotate180)
+        return ""
+
+    def filter_usb_data(self, usb_data):
+        """
+        Feeds the cells that changed since the last reading to the reading filter,
+        returns the FEN of the accepted pieces or "" if any of them is unknown
+        """
+        dirty_cells = frames.diff_cells(self.last_usb_data, usb_data)
+        self.last_usb_data = usb_data
+        for n_cell in dirty_cells:
+            name = codes.get_name(frames.cell_code(usb_data, n_cell))
+            self.usb_cells[n_cell] = "." if name == "-" else name
+        self.reading_filter.update(self.usb_cells, dirty_cells)
+
+        cells = self.reading_filter.accepted
+        if "" in cells:
+            return ""
+        if self.rotate180:
+            cells = cells[::-1]
+        return cells_to_fen(cells) + " w KQkq - 0 1"
 
     def calibrate_from_usb_data(self, usb_data):
         self.calibration_samples.append(usb_data)
@@ -168,6 +264,7 @@ class Certabo:
             usb_data = codes.statistic_processing_for_calibration(self.calibration_samples, False)
             codes.calibration(usb_data, self.new_setup, self.calibration_filepath)
             self.calibration = False
+            self.last_usb_data = None  # decode every cell again with the new codes
             logging.info('calibration ok') 
             self.send_leds()
         elif self.calibration_samples_counter %2:
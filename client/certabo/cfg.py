@@ -17,6 +17,8 @@ parser.add_argument("--syzygy", help="Syzygy path")
 parser.add_argument("--hide-cursor", help="Hide cursor", action="store_true")
 parser.add_argument("--max-depth", help="Maximum depth", type=int, default=20)
 parser.add_argument('--debug', help='Debug mode (additional options: {off, led, pystockfish, reading, analysis, fps})', nargs='*')
+parser.add_argument('--record', help='Record what the board sends to a session file (in the data folder if no path is given)',
+                    nargs='?', const='auto')
 parser.add_argument('--port-not-strict', help='Whether find_port runs in strict mode', action='store_false')
 # multiprocessing extra arguments (not used by us)
 parser.add_argument('--multiprocessing-fork', nargs='*')
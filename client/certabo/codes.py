@@ -1,13 +1,23 @@
 from __future__ import print_function
-import pickle
-import os
-import chess
 import logging
 import struct
 
+from utils import move_inference, led_encoding, board_diff, calibration_store
+
+# Optional, used to vote on the reading history in bulk
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 # data conversion
 p, r, n, b, k, q, P, R, N, B, K, Q = [], [], [], [], [], [], [], [], [], [], [], []
 
+# 5 byte code -> piece letter, rebuilt from the lists above whenever the calibration changes
+code_index = {}
+# the same codes packed into integers, for the numpy backend
+known_codes = None
+
 # for calibration
 def cell_codes(n_cell, usb_data):  # n_cell from 0 to 63, 0 at left top
     result = []
@@ -35,20 +45,92 @@ def load_calibration(filename):
     global p, r, n, b, k, q, P, R, N, B, K, Q
     logging.info("codes.py - loading calibration")
     try:
-        p, r, n, b, k, q, P, R, N, B, K, Q = pickle.load(
-            open(filename, "rb")
-        )
+        calibration = calibration_store.load(filename)
     except (IOError, OSError):
         logging.info("WARNING: no calibration found")
         return False
     except ValueError:
         logging.info("Can't load calibration data")
         return False
+    p, r, n, b, k, q, P, R, N, B, K, Q = (
+        [list(code) for code in calibration[letter]] for letter in calibration_store.PIECE_ORDER
+    )
+    build_code_index()
     return True
 
 
+def build_code_index():
+    """
+    Builds the code -> piece letter dictionary used to decode board cells in O(1).
+
+    Later piece types take precedence over earlier ones, same as the linear search used to.
+    Codes shared by two piece types are reported, as the board cannot tell those pieces apart.
+    """
+    global code_index, known_codes
+    index = {}
+    for letter, piece_codes in zip(
+        ("p", "P", "r", "R", "n", "N", "b", "B", "q", "Q", "k", "K"),
+        (p, P, r, R, n, N, b, B, q, Q, k, K),
+    ):
+        for code in piece_codes:
+            key = bytes(int(c) for c in code)
+            previous = index.get(key)
+            if previous is not None and previous != letter:
+                logging.warning("Piece code %s is assigned to both %s and %s", list(key), previous, letter)
+            index[key] = letter
+    code_index = index
+    if numpy is not None:
+        known_codes = numpy.array([int.from_bytes(key, "big") for key in index], dtype=numpy.int64)
+    return index
+
+
+def stack_samples(samples):
+    """
+    Stacks a history of readings into a (depth, 64, 5) array of codes,
+    and the same codes packed into 40 bit integers as a (depth, 64) array
+    """
+    if isinstance(samples[0], bytes):
+        cells = numpy.frombuffer(b"".join(samples), dtype=numpy.uint8).astype(numpy.int64)
+    else:
+        cells = numpy.array(samples, dtype=numpy.int64)
+    cells = cells.reshape(len(samples), 64, 5)
+    packed = cells @ (256 ** numpy.arange(4, -1, -1, dtype=numpy.int64))
+    return cells, packed
+
+
+def most_common_cells(candidates, packed):
+    """
+    For each cell, returns the index of the first candidate code that is most often found in the history
+    """
+    histograms = (candidates[:, None, :] == packed[None, :, :]).sum(axis=1)
+    return histograms.argmax(axis=0)
+
+
+def statistic_processing_for_calibration_numpy(samples):
+    cells, packed = stack_samples(samples)
+    best = most_common_cells(packed, packed)
+    return cells[best, numpy.arange(64)].reshape(-1).tolist()
+
+
+def statistic_processing_numpy(samples):
+    if len(samples) == 0:
+        return []
+    cells, packed = stack_samples(samples)
+
+    # unknown codes are replaced by 0, but still counted against the original readings
+    empty = (cells == 0).sum(axis=2) > 2
+    known = empty | numpy.isin(packed, known_codes)
+    best = most_common_cells(numpy.where(known, packed, 0), packed)
+
+    cell_range = numpy.arange(64)
+    result = cells[best, cell_range] * known[best, cell_range][:, None]
+    return result.reshape(-1).tolist()
+
+
 def statistic_processing_for_calibration(samples, show_print):
     global letters
+    if numpy is not None and not show_print:
+        return statistic_processing_for_calibration_numpy(samples)
     result = []
     for n_cell in range(64):
         cells = []
@@ -80,51 +162,18 @@ def statistic_processing_for_calibration(samples, show_print):
 
 
 def get_name(cell):
-    global p, r, n, b, k, q, P, R, N, B, K, Q
-    c = ""
+    c = code_index.get(bytes(cell))
+    if c is not None:
+        return c
     if cell_empty(cell):
-        c = "-"
-    for cell_p in p:
-        if compare_cells(cell, cell_p):
-            c = "p"
-    for cell_p in P:
-        if compare_cells(cell, cell_p):
-            c = "P"
-    for cell_p in r:
-        if compare_cells(cell, cell_p):
-            c = "r"
-    for cell_p in R:
-        if compare_cells(cell, cell_p):
-            c = "R"
-    for cell_p in n:
-        if compare_cells(cell, cell_p):
-            c = "n"
-    for cell_p in N:
-        if compare_cells(cell, cell_p):
-            c = "N"
-    for cell_p in b:
-        if compare_cells(cell, cell_p):
-            c = "b"
-    for cell_p in B:
-        if compare_cells(cell, cell_p):
-            c = "B"
-    for cell_p in q:
-        if compare_cells(cell, cell_p):
-            c = "q"
-    for cell_p in Q:
-        if compare_cells(cell, cell_p):
-            c = "Q"
-    for cell_p in k:
-        if compare_cells(cell, cell_p):
-            c = "k"
-    for cell_p in K:
-        if compare_cells(cell, cell_p):
-            c = "K"
-    return c
+        return "-"
+    return ""
 
 
 def statistic_processing(samples, show_print):
     global letters
+    if numpy is not None and known_codes is not None and not show_print:
+        return statistic_processing_numpy(samples)
     result = []
     found_unknown_cell = False
     for n_cell in range(64):
@@ -303,57 +352,18 @@ def calibration(usb_data, new_setup, filename):
             Kn,
             Qn,
         )
-    pickle.dump(results, open(filename, "wb"))
+    calibration_store.save(filename, dict(zip(calibration_store.PIECE_ORDER, results)))
+    build_code_index()
 
     logging.info("----------------")
-    # print r
-    #    print compare_cells(p[0], p[1])
-
     for j in range(8):
         row = []
         for i in range(8):
             cell = cell_codes(i + j * 8, usb_data)
-            # print cell
-            # print empty_cell
             if cell_empty(cell):
                 row.append("-")
-            else:  # not empty
-                for cell_p in p:
-                    if compare_cells(cell, cell_p):
-                        row.append("p")
-                for cell_p in P:
-                    if compare_cells(cell, cell_p):
-                        row.append("P")
-                for cell_p in r:
-                    if compare_cells(cell, cell_p):
-                        row.append("r")
-                for cell_p in R:
-                    if compare_cells(cell, cell_p):
-                        row.append("R")
-                for cell_p in n:
-                    if compare_cells(cell, cell_p):
-                        row.append("n")
-                for cell_p in N:
-                    if compare_cells(cell, cell_p):
-                        row.append("N")
-                for cell_p in b:
-                    if compare_cells(cell, cell_p):
-                        row.append("b")
-                for cell_p in B:
-                    if compare_cells(cell, cell_p):
-                        row.append("B")
-                for cell_p in q:
-                    if compare_cells(cell, cell_p):
-                        row.append("q")
-                for cell_p in Q:
-                    if compare_cells(cell, cell_p):
-                        row.append("Q")
-                for cell_p in k:
-                    if compare_cells(cell, cell_p):
-                        row.append("k")
-                for cell_p in K:
-                    if compare_cells(cell, cell_p):
-                        row.append("K")
+            elif bytes(cell) in code_index:
+                row.append(code_index[bytes(cell)])
         logging.info(" ".join(row))
 
 
@@ -379,115 +389,49 @@ def move2led(move, rotate180=False):
     return 8 - j, 2 ** i, 8 - l, 2 ** k
 
 def move2ledbytes(move, rotate180=False):
-    i, value, i_source, value_source = move2led(move, rotate180)
-    message = bytearray()
-    for j in range(8):
-        if j != i and j != i_source:
-            message.append(0)
-        elif j == i and j == i_source:
-            message.append(value + value_source)
-        elif j == i:
-            message.append(value)
-        else:
-            message.append(value_source)
-    return message
+    return led_encoding.encode(move, rotate180)
 
 def diff2squareset(s1, s2):
-    board1 = chess.BaseBoard(s1)
-    board2 = chess.BaseBoard(s2)
-    diffmap = chess.SquareSet()
-    for x in range(chess.A1, chess.H8+1):
-        if board1.piece_at(x) != board2.piece_at(x):
-            diffmap.add(x)
-    return diffmap
+    return board_diff.diff_squareset(s1, s2)
 
 def squareset2ledbytes(squareset):
     # we pack the uint64 squareset bitmask into a big endian bytearray
-    return int(squareset).to_bytes(8, byteorder="big", signed=False)
+    return led_encoding.mask_to_frame(int(squareset))
 
 def usb_data_to_FEN(usb_data, rotate180=False):
-    global letter
-    empty_cell = [0, 0, 0, 0, 0]
     s = ""
     was_unknown_piece = False
     for j in range(8):
-
-        c = ""
         empty_cells_counter = 0
         for i in range(8):
-            cell = cell_codes(i + j * 8, usb_data)
-            c = "unknown"
-
+            n_cell = i + j * 8
+            cell = usb_data[n_cell * 5: n_cell * 5 + 5]
             if cell_empty(cell):
-                c = "-"
                 empty_cells_counter += 1
-            else:  # not empty
-
-                for cell_p in p:
-                    if compare_cells(cell, cell_p):
-                        c = "p"
-                for cell_p in P:
-                    if compare_cells(cell, cell_p):
-                        c = "P"
-                for cell_p in r:
-                    if compare_cells(cell, cell_p):
-                        c = "r"
-                for cell_p in R:
-                    if compare_cells(cell, cell_p):
-                        c = "R"
-                for cell_p in n:
-                    if compare_cells(cell, cell_p):
-                        c = "n"
-                for cell_p in N:
-                    if compare_cells(cell, cell_p):
-                        c = "N"
-                for cell_p in b:
-                    if compare_cells(cell, cell_p):
-                        c = "b"
-                for cell_p in B:
-                    if compare_cells(cell, cell_p):
-                        c = "B"
-                for cell_p in q:
-                    if compare_cells(cell, cell_p):
-                        c = "q"
-                for cell_p in Q:
-                    if compare_cells(cell, cell_p):
-                        c = "Q"
-                for cell_p in k:
-                    if compare_cells(cell, cell_p):
-                        c = "k"
-                for cell_p in K:
-                    if compare_cells(cell, cell_p):
-                        c = "K"
-
-                if empty_cells_counter > 0 and c != "-":
-                    s += str(empty_cells_counter)
-                    empty_cells_counter = 0
-                    s += c
-                elif empty_cells_counter == 0 and c != "-":
-                    s += c
-                if c == "unknown":
-                    #                    print "Unknown piece at cell n =",j*8+i, ", ",letter[i]+str(8-j)
-                    logging.info("Unknown piece at %s", letter[i] + str(8 - j))
-                    was_unknown_piece = True
-        if empty_cells_counter > 0 and c == "-":
+                continue
+
+            c = code_index.get(bytes(cell))
+            if c is None:
+                logging.info("Unknown piece at %s", letter[i] + str(8 - j))
+                was_unknown_piece = True
+                continue
+
+            if empty_cells_counter > 0:
+                s += str(empty_cells_counter)
+                empty_cells_counter = 0
+            s += c
+        if empty_cells_counter > 0:
             s += str(empty_cells_counter)
-            empty_cells_counter = 0
 
         if j != 7:
             s += r"/"
 
-        # s += c
-        # ss = ""
-        # for i in range(8):
-
     # "rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1"
     if rotate180:
         s = '/'.join(row[::-1] for row in reversed(s.split('/')))
     s += " w KQkq - 0 1"
     if was_unknown_piece:
         return ""
-    # print s
     return s
 
 
@@ -604,30 +548,24 @@ def get_moves(board, fen, max_depth =2):
     :param max_depth:
     :return:
     """
-    board_fen = fen.split()[0]
-    # logging.debug('Getting diff between {} and {}'.format(board.board_fen(), board_fen))
-    if board.board_fen() == board_fen:
+    physical_board = move_inference.to_base_board(fen)
+    if physical_board is None:
+        logging.debug('Unable to detect moves')
+        raise InvalidMove()
+    changed = move_inference.changed_mask(board, physical_board)
+    if not changed:
         # logging.debug('Positions identical')
         return []
-    copy_board = board.copy()  # type: chess.Board
-    moves = list(board.generate_legal_moves())
-    for move in moves:
-        copy_board.push(move)
-        if board_fen == copy_board.board_fen():
-            logging.debug('Single move detected - {}'.format(move.uci()))
-            return [move.uci()]
-        copy_board.pop()
+    moves = move_inference.infer_moves(board, physical_board, changed)
+    if moves:
+        logging.debug('Single move detected - {}'.format(moves[0].uci()))
+        return [moves[0].uci()]
     if max_depth > 1:
-        for move in moves:
-            copy_board.push(move)
-            legal_moves2 = list(copy_board.generate_legal_moves())
-            for move2 in legal_moves2:
-                copy_board.push(move2)
-                if board_fen == copy_board.board_fen():
-                    logging.debug('Double move detected - {}, {}'.format(move.uci(), move2.uci()))
-                    return [move.uci(), move2.uci()]
-                copy_board.pop()
-            copy_board.pop()
+        pairs = move_inference.infer_double_moves(board, physical_board)
+        if pairs:
+            move, move2 = pairs[0]
+            logging.debug('Double move detected - {}, {}'.format(move.uci(), move2.uci()))
+            return [move.uci(), move2.uci()]
     logging.debug('Unable to detect moves')
     raise InvalidMove()
 
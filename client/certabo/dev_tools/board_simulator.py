@@ -0,0 +1,484 @@
+"""
+Simulates a Certabo board, so reading performance can be measured (and checked in CI) without hardware.
+
+The simulator emits the same 320 value lines as the board, with optional noise (corrupted bytes, which
+read as unknown codes), flicker (pieces briefly not read) and corrupt lines, over a pty or a TCP socket.
+It can also replay recorded sessions, and benchmark the reading code unchanged: BoardReader alone, or
+behind usbtool or serialreader reading a pty.
+
+    python dev_tools/board_simulator.py serve --pty --rate 10 --noise .01
+    python dev_tools/board_simulator.py serve --tcp 5555 --fen 8/8/8/3k4/8/8/3K4/8
+    python dev_tools/board_simulator.py replay session.txt --pty --speed 2
+    python dev_tools/board_simulator.py bench --target usbtool --duration 20 --max-move-latency-ms 600
+
+Recordings are session files written with --record (see utils.session_recorder), or text files with one
+board line per line, optionally preceded by its time in seconds since the start of the session
+(e.g., '0.083 :0 0 0 ...').
+"""
+import sys
+from pathlib import Path
+sys.path.append(str(Path(__file__).parent.parent))
+
+# cfg parses the command line when imported, keep our own arguments away from it
+ARGV = sys.argv[1:]
+if __name__ == '__main__':
+    del sys.argv[1:]
+
+import argparse
+import json
+import logging
+import os
+import pty
+import queue
+import random
+import socket
+import tempfile
+import threading
+import time
+
+import chess
+
+from utils import calibration_store, frames, get_moves, reading_filter, session_recorder, usbtool
+from utils.reader_writer import BoardReader, fen_to_cells
+from serialreader import serialreader
+
+SIMULATOR_PORTNAME = 'simulator'
+
+
+class BoardSimulator:
+    def __init__(self, board_fen=chess.STARTING_BOARD_FEN, noise=0., flicker=0., corrupt=0., seed=None):
+        """
+        noise: probability that a cell reads with one corrupted byte (an unknown code)
+        flicker: probability that an occupied cell reads empty
+        corrupt: probability that a whole line is cut short
+        """
+        self.random = random.Random(seed)
+        self.noise = noise
+        self.flicker = flicker
+        self.corrupt = corrupt
+        self.codes = {}  # piece letter -> codes of every piece of that kind, like a calibration
+        self.used_codes = set()
+        self.cells = [None] * 64  # code of the piece on each cell (0 is a8)
+        self.board_fen = None
+        self.leds = None  # last led frame written by the reader
+        self.set_fen(board_fen)
+
+    def new_code(self, letter):
+        while True:
+            code = bytes(self.random.randrange(1, 256) for _ in range(frames.CODE_LENGTH))
+            if code not in self.used_codes:
+                break
+        self.used_codes.add(code)
+        self.codes.setdefault(letter, []).append(code)
+        return code
+
+    def set_fen(self, board_fen):
+        """
+        Places pieces as in board_fen, pieces of the same kind get their codes in a fixed order
+        """
+        board_fen = board_fen.split()[0]
+        counts = {}
+        for n_cell, letter in enumerate(fen_to_cells(board_fen)):
+            if letter == '.':
+                self.cells[n_cell] = None
+                continue
+            n = counts.get(letter, 0)
+            counts[letter] = n + 1
+            codes = self.codes.get(letter, [])
+            self.cells[n_cell] = codes[n] if n < len(codes) else self.new_code(letter)
+        self.board_fen = board_fen
+
+    def move_to(self, board_fen):
+        """
+        Moves the pieces to board_fen, keeping the code of each piece that moved (captures, castling,
+        en passant and promotions included)
+        """
+        old_cells = fen_to_cells(self.board_fen)
+        new_cells = fen_to_cells(board_fen.split()[0])
+        lifted = {}
+        for n_cell, (old, new) in enumerate(zip(old_cells, new_cells)):
+            if old != new and old != '.':
+                lifted.setdefault(old, []).append(self.cells[n_cell])
+                self.cells[n_cell] = None
+        for n_cell, (old, new) in enumerate(zip(old_cells, new_cells)):
+            if old != new and new != '.':
+                codes = lifted.get(new)
+                self.cells[n_cell] = codes.pop() if codes else self.spare_code(new)
+        self.board_fen = board_fen.split()[0]
+
+    def spare_code(self, letter):
+        """
+        A code of this kind of piece that is not on the board (e.g., a queen for a promotion)
+        """
+        on_board = set(self.cells)
+        for code in self.codes.get(letter, []):
+            if code not in on_board:
+                return code
+        return self.new_code(letter)
+
+    def calibration(self):
+        return {letter: list(self.codes.get(letter, [])) for letter in calibration_store.PIECE_ORDER}
+
+    def frame(self):
+        noisy = self.noise or self.flicker
+        data = bytearray()
+        for code in self.cells:
+            if code is None:
+                data += frames.EMPTY_CODE
+                continue
+            if noisy:
+                r = self.random.random()
+                if r < self.flicker:
+                    data += frames.EMPTY_CODE
+                    continue
+                if r < self.flicker + self.noise:
+                    code = bytearray(code)
+                    code[self.random.randrange(frames.CODE_LENGTH)] ^= 1 << self.random.randrange(8)
+            data += code
+        return bytes(data)
+
+    def line(self):
+        line = frames.format_frame(self.frame())
+        if self.corrupt and self.random.random() < self.corrupt:
+            line = line[:self.random.randrange(1, len(line) - 2)] + b'\r\n'
+        return line
+
+    def lines(self, rate):
+        """
+        Yields (delay, line) forever, delay being the time to wait before sending the line
+        """
+        delay = 1 / rate if rate else 0
+        while True:
+            yield delay, self.line()
+
+
+def read_recording(path, rate=10., speed=1.):
+    """
+    Yields (delay, line) for the board lines of a recording, using their timestamps if they have them
+    """
+    if session_recorder.is_session_file(path):
+        last_time = None
+        for record in session_recorder.read_session(path):
+            if record.kind == 'leds':
+                continue
+            delay = 0. if last_time is None else min(max(0., record.timestamp - last_time), 5.)
+            last_time = record.timestamp
+            line = frames.format_frame(record.data) if record.kind == 'frame' else record.data
+            yield delay / speed, line
+        return
+
+    last_time = None
+    with open(path, 'rb') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            timestamp = None
+            if not line.startswith(b':'):
+                timestamp, _, line = line.partition(b' ')
+                try:
+                    timestamp = float(timestamp)
+                except ValueError:
+                    continue
+            if timestamp is None or last_time is None:
+                delay = 1 / rate if rate else 0
+            else:
+                delay = max(0., timestamp - last_time)
+            if timestamp is not None:
+                last_time = timestamp
+            yield delay / speed, line + b' \r\n'
+
+
+def stream(write, lines, stop):
+    """
+    Writes (delay, line) items at their pace until stop is set or lines run out
+    """
+    next_time = time.monotonic()
+    for delay, line in lines:
+        next_time += delay
+        wait = next_time - time.monotonic()
+        if wait > 0:
+            if stop.wait(wait):
+                return
+        elif stop.is_set():
+            return
+        write(line)
+
+
+def open_pty(simulator=None):
+    """
+    Returns (master fd, device path). Led frames written to the device are read in the background
+    and kept in simulator.leds, so the reader never blocks on a full pty.
+    """
+    master, slave = pty.openpty()
+    path = os.ttyname(slave)
+
+    def drain_leds():
+        while True:
+            try:
+                data = os.read(master, 1024)
+            except OSError:
+                return
+            if simulator is not None and len(data) >= 8:
+                simulator.leds = data[-8:]
+
+    threading.Thread(target=drain_leds, daemon=True).start()
+    return master, path
+
+
+def serve_pty(lines, simulator=None, stop=None):
+    stop = stop or threading.Event()
+    master, path = open_pty(simulator)
+    print(f'Board available at {path} (e.g., --usbport {path})')
+    stream(lambda line: os.write(master, line), lines, stop)
+
+
+def serve_tcp(port, lines, stop=None):
+    """
+    Streams lines to one client at a time (e.g., the bluetooth bridge or utils.aio_transport)
+    """
+    stop = stop or threading.Event()
+    server = socket.create_server(('', port))
+    print(f'Board available on port {port}')
+    while not stop.is_set():
+        connection, address = server.accept()
+        logging.info(f'Client connected from {address}')
+        try:
+            stream(connection.sendall, lines, stop)
+        except OSError as e:
+            logging.info(f'Client disconnected: {e}')
+        finally:
+            connection.close()
+    server.close()
+
+
+def percentiles(samples, scale=1000):
+    if not samples:
+        return None
+    samples = sorted(samples)
+    pick = lambda p: samples[min(len(samples) - 1, int(p * len(samples)))] * scale
+    return {'p50': pick(.5), 'p90': pick(.9), 'p99': pick(.99), 'max': samples[-1] * scale}
+
+
+def random_games(seed=None, max_plies=60):
+    """
+    Yields (board FEN, move) for the moves of random games, starting a new game (move None)
+    after max_plies or when one ends
+    """
+    rng = random.Random(seed)
+    while True:
+        board = chess.Board()
+        for _ in range(max_plies):
+            moves = list(board.legal_moves)
+            if not moves:
+                break
+            move = rng.choice(moves)
+            board.push(move)
+            yield board.board_fen(), move
+        yield chess.STARTING_BOARD_FEN, None
+
+
+def make_filter(name):
+    if name == 'consecutive':
+        return reading_filter.ConsecutiveFilter()
+    if name == 'confidence':
+        return reading_filter.ConfidenceFilter()
+    return None
+
+
+def benchmark(target='boardreader', duration=10., rate=10., move_interval=1., filter_name=None,
+              noise=0., flicker=0., corrupt=0., seed=0):
+    """
+    Plays random games on the simulator while a BoardReader follows them, and reports:
+        frames_per_second: readings processed by BoardReader
+        decode_ms: time taken by BoardReader.update for each reading
+        move_latency_ms: time from a move on the simulator until move detection (utils.get_moves) returns it
+
+    target is 'boardreader' (readings handed straight to BoardReader, as fast as rate allows or
+    unthrottled if rate is 0), 'usbtool' or 'serialreader' (both reading a pty)
+    """
+    simulator = BoardSimulator(noise=noise, flicker=flicker, corrupt=corrupt, seed=seed)
+    readings = queue.Queue(maxsize=64)
+    # The calibration of the simulated pieces is kept away from the user's data folder
+    data_dir = tempfile.TemporaryDirectory()
+    reader = BoardReader(SIMULATOR_PORTNAME, make_filter(filter_name), queue=readings, data_path=data_dir.name)
+    calibration_store.save(reader.calibration_filepath, simulator.calibration())
+    reader.load_piece_codes()
+
+    lock = threading.Lock()
+    games = random_games(seed)
+    virtual_board = chess.Board()  # the moves detected so far, as the client plays them
+    pending = None  # (board fen, move, time it was played on the simulator) until the move is detected
+    stop = threading.Event()
+
+    def play_move():
+        nonlocal pending
+        if pending is not None and pending[1] is not None:
+            virtual_board.push(pending[1])  # missed, keep following the game
+        fen, move = next(games)
+        if move is None:
+            virtual_board.reset()
+        with lock:
+            simulator.move_to(fen)
+        pending = (fen, move, time.perf_counter()) if move is not None else None
+
+    if target == 'boardreader':
+        def next_frame(timeout):
+            if rate:
+                time.sleep(1 / rate)
+            with lock:
+                return frames.parse_frame(simulator.line())
+    else:
+        master, path = open_pty(simulator)
+
+        def feed():
+            while not stop.is_set():
+                with lock:
+                    line = simulator.line()
+                os.write(master, line)
+                if stop.wait(1 / rate if rate else 0):
+                    return
+        threading.Thread(target=feed, daemon=True).start()
+
+        if target == 'usbtool':
+            threading.Thread(target=usbtool._usbtool, args=(path, queue.Queue(), readings), daemon=True).start()
+        elif target == 'serialreader':
+            device = serialreader(readings.put, path)
+            device.daemon = True
+            device.start()
+        else:
+            raise ValueError(f'Unknown benchmark target {target}')
+
+        def next_frame(timeout):
+            try:
+                return readings.get(timeout=timeout)
+            except queue.Empty:
+                return None
+
+        # Wait for the link to come up before starting the clock
+        if next_frame(timeout=10) is None:
+            raise RuntimeError(f'No readings from {target}')
+
+    decode_times = []
+    move_latencies = []
+    n_frames = n_moves = 0
+    try:
+        start = last_move = time.perf_counter()
+        while time.perf_counter() - start < duration:
+            frame = next_frame(timeout=.5)
+            if frame is None:
+                continue
+            decode_start = time.perf_counter()
+            reader.update(frame)
+            decode_end = time.perf_counter()
+            decode_times.append(decode_end - decode_start)
+            n_frames += 1
+
+            if pending is not None and reader.board_fen == pending[0]:
+                moves = get_moves.get_moves(virtual_board, reader.board_fen)
+                if moves == [pending[1].uci()]:
+                    move_latencies.append(time.perf_counter() - pending[2])
+                    virtual_board.push(pending[1])
+                    pending = None
+            if decode_end - last_move >= move_interval:
+                last_move = decode_end
+                play_move()
+                n_moves += pending is not None
+        elapsed = time.perf_counter() - start
+    finally:
+        stop.set()
+        data_dir.cleanup()
+
+    return {
+        'target': target,
+        'filter': filter_name,
+        'frames': n_frames,
+        'frames_per_second': n_frames / elapsed,
+        'decode_ms': percentiles(decode_times),
+        'moves': n_moves,
+        'moves_detected': len(move_latencies),
+        'move_latency_ms': percentiles(move_latencies),
+    }
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Certabo board simulator')
+    parser.add_argument('-v', '--verbose', action='store_true')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    def add_noise_arguments(command):
+        command.add_argument('--rate', type=float, default=10., help='Readings per second (0: unthrottled)')
+        command.add_argument('--noise', type=float, default=0., help='Probability of a corrupted code per cell')
+        command.add_argument('--flicker', type=float, default=0., help='Probability of a piece not being read')
+        command.add_argument('--corrupt', type=float, default=0., help='Probability of a truncated line')
+        command.add_argument('--seed', type=int, default=None)
+
+    def add_output_arguments(command):
+        output = command.add_mutually_exclusive_group(required=True)
+        output.add_argument('--pty', action='store_true', help='Serve on a pseudo terminal')
+        output.add_argument('--tcp', type=int, metavar='PORT', help='Serve on a TCP port')
+
+    serve = commands.add_parser('serve', help='Emit readings of a fixed position')
+    serve.add_argument('--fen', default=chess.STARTING_BOARD_FEN)
+    add_noise_arguments(serve)
+    add_output_arguments(serve)
+
+    replay = commands.add_parser('replay', help='Emit the readings of a recording')
+    replay.add_argument('path')
+    replay.add_argument('--rate', type=float, default=10., help='Readings per second for lines without timestamp')
+    replay.add_argument('--speed', type=float, default=1.)
+    replay.add_argument('--loop', action='store_true')
+    add_output_arguments(replay)
+
+    bench = commands.add_parser('bench', help='Measure reading throughput and latency')
+    bench.add_argument('--target', choices=('boardreader', 'usbtool', 'serialreader'), default='boardreader')
+    bench.add_argument('--duration', type=float, default=10.)
+    bench.add_argument('--move-interval', type=float, default=1.)
+    bench.add_argument('--filter', choices=('consecutive', 'confidence'), default=None)
+    bench.add_argument('--min-fps', type=float, default=None, help='Fail if fewer readings per second are processed')
+    bench.add_argument('--max-move-latency-ms', type=float, default=None, help='Fail if the p90 move latency is higher')
+    add_noise_arguments(bench)
+
+    args = parser.parse_args(argv)
+    logging.basicConfig(level='DEBUG' if args.verbose else 'WARNING', format='%(asctime)s:%(module)s:%(message)s')
+
+    if args.command == 'bench':
+        report = benchmark(args.target, args.duration, args.rate, args.move_interval, args.filter,
+                           args.noise, args.flicker, args.corrupt, args.seed or 0)
+        print(json.dumps(report, indent=2))
+        failures = []
+        if args.min_fps is not None and report['frames_per_second'] < args.min_fps:
+            failures.append(f'{report["frames_per_second"]:.1f} readings per second < {args.min_fps}')
+        if args.max_move_latency_ms is not None:
+            latency = report['move_latency_ms']
+            if latency is None or latency['p90'] > args.max_move_latency_ms:
+                failures.append(f'p90 move latency {latency and latency["p90"]} ms > {args.max_move_latency_ms}')
+        for failure in failures:
+            print(f'FAILED: {failure}')
+        return 1 if failures else 0
+
+    if args.command == 'serve':
+        simulator = BoardSimulator(args.fen, args.noise, args.flicker, args.corrupt, args.seed)
+        lines = simulator.lines(args.rate)
+    else:
+        simulator = None
+
+        def replay_lines():
+            while True:
+                yield from read_recording(args.path, args.rate, args.speed)
+                if not args.loop:
+                    return
+        lines = replay_lines()
+
+    try:
+        if args.pty:
+            serve_pty(lines, simulator)
+        else:
+            serve_tcp(args.tcp, lines)
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(ARGV))
@@ -22,9 +22,11 @@ from messchess import RomEngine  # TODO: Try to use Python-chess
 from publish import Publisher
 
 from utils.analysis_engine import GameEngine, AnalysisEngine
-from utils.get_moves import get_moves, is_move_back
+from utils.get_moves import get_moves, is_move_back, reset_move_cache
 from utils.game_clock import GameClock
 from utils.remote_control import RemoteControl
+from utils.reading_filter import create_reading_filter
+from utils.led_scheduler import PRIORITY_HINT
 from utils import media, logger, reader_writer, usbtool
 from utils.media import create_button, coords_in, show_text, show_sprite, play_audio, COLORS
 from utils.get_books_engines import get_book_list, get_engine_list, CERTABO_SAVE_PATH
@@ -94,7 +96,7 @@ if __name__ == '__main__':
                 thread.kill()
 
         try:
-            led_manager.set_leds()
+            led_manager.set_leds(replace=True)
             time.sleep(.750)  # Allow sometime to send led instruction before killing usbtool!
         except NameError:
             pass
@@ -260,7 +262,7 @@ if __name__ == '__main__':
         banner_fix_pieces = True
         hint_text = ""
         show_analysis = False
-        led_manager.set_leds()
+        led_manager.set_leds(replace=True)
 
 
     # ----------- Create Pygame Window
@@ -410,6 +412,7 @@ if __name__ == '__main__':
         'address_chessboard': None,
         'connection_method': 'usb',
         'remote_control': False,
+        'reading_filter': 'majority',  # or e.g. {'type': 'consecutive', 'reads': 2}, see utils.reading_filter
     }
     certabo_settings_filepath = os.path.join(logger.CERTABO_DATA_PATH, 'certabo_settings.json')
     if not os.path.exists(certabo_settings_filepath):
@@ -546,7 +549,8 @@ if __name__ == '__main__':
         json.dump(certabo_settings, f)
 
     # Initialize modules
-    usb_reader = reader_writer.BoardReader(certabo_settings['address_chessboard'])
+    usb_reader = reader_writer.BoardReader(certabo_settings['address_chessboard'],
+                                           create_reading_filter(certabo_settings.get('reading_filter')))
     usb_reader.ignore_missing = not certabo_settings['remote_control']
     led_manager = reader_writer.LedWriter()
     remote_control = RemoteControl(led_manager, certabo_settings['remote_control'])
@@ -897,7 +901,7 @@ if __name__ == '__main__':
                 # Countdown completed
                 else:
                     window = 'new game'
-                    led_manager.set_leds()
+                    led_manager.set_leds(replace=True)
 
             # Display elements that do not depend on game state
             show_board(chessboard.fen())
@@ -1000,7 +1004,7 @@ if __name__ == '__main__':
 
                 terminal_print(f'hint: {hint_text}')
                 logging.info(f'Hint: {hint_text}')
-                led_manager.flash_leds(hint_text)
+                led_manager.flash_leds(hint_text, priority=PRIORITY_HINT)
                 continue
 
             # Process analysis
@@ -1050,7 +1054,7 @@ if __name__ == '__main__':
                 if chessboard.is_check() and not game_settings['human_game']:
                     # Find king on check
                     checked_king_square = chess.SQUARE_NAMES[chessboard.king(chessboard.turn)]
-                    led_manager.set_leds(checked_king_square, game_settings['rotate180'])
+                    led_manager.pulse_leds(checked_king_square, game_settings['rotate180'])
 
                 # Show time warning leds
                 elif game_clock.time_warning(chessboard) and not game_settings['human_game']:
@@ -1058,10 +1062,10 @@ if __name__ == '__main__':
 
                 # Show hint leds
                 elif hint_text:
-                    led_manager.flash_leds(hint_text)
+                    led_manager.flash_leds(hint_text, priority=PRIORITY_HINT)
                 # no leds
                 else:
-                    led_manager.set_leds()
+                    led_manager.set_leds(replace=True)
 
                 # Deactivate banners
                 banner_certabo_move = False
@@ -1150,7 +1154,7 @@ if __name__ == '__main__':
 
                     if not game_overtime:
                         logging.info(f"AI move: {ai_move}")
-                        led_manager.set_leds(ai_move, game_settings['rotate180'])
+                        led_manager.set_leds(ai_move, game_settings['rotate180'], replace=True)
                         play_audio('move')
 
                         if not cfg.args.robust:
@@ -1305,7 +1309,7 @@ if __name__ == '__main__':
                             chessboard = chess.Board()
                             dialog = ""
                             window = "home"
-                            led_manager.set_leds()
+                            led_manager.set_leds(replace=True)
                         else:  # save button
                             dialog = ""
                             window = "save"
@@ -1619,6 +1623,7 @@ if __name__ == '__main__':
             if start_game:
                 logging.info('Starting game')
                 start_game = False
+                reset_move_cache()
                 window = "game"
                 if resuming_new_game:
                     resuming_new_game = False
@@ -1751,7 +1756,8 @@ if __name__ == '__main__':
             show_text(f'FPS = {fps:.1f}', 5, 5, color=COLORS['black'])
 
         pygame.display.flip()
-        time.sleep(.001)
+        # Sleep until the board changes, but redraw often enough for mouse input, clocks and engine output
+        usb_reader.wait_for_change(timeout=1 / 30)
 
         if window != "home":
             usb_reader.ignore_missing = True
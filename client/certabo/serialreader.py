@@ -22,6 +22,7 @@ elif os.name == 'posix':
     from serial.tools.list_ports_posix import comports
 
 from utils.usbtool import find_address
+from utils import frames, led_scheduler, session_recorder
 
 
 def find_port_():
@@ -59,11 +60,29 @@ class serialreader(threading.Thread):
         self.handler = handler
         self.uart = None
         self.buf = bytearray()
+        self.leds = led_scheduler.LedScheduler()
+        # send_led is called from the GUI and animator threads, flush_leds from this one
+        self.leds_lock = threading.Lock()
+        self.recorder = None  # opened once the port is known, see run
 
-    def send_led(self, message: bytes):
+    def send_led(self, message: bytes, priority=led_scheduler.PRIORITY_NORMAL, replace=False):
         # logging.debug(f'Sending to serial: {message}')
-        if self.connected:
-            return self.uart.write(message)
+        # Identical frames are dropped and bursts coalesced, see utils.led_scheduler
+        self.leds.submit(message, priority, replace)
+        self.flush_leds()
+
+    def flush_leds(self):
+        """
+        Writes the pending led frame if the scheduler allows it, called again after every reading.
+        Frames are taken and written under one lock, so they reach the board in the order they were scheduled.
+        """
+        with self.leds_lock:
+            if self.connected:
+                message = self.leds.next_frame()
+                if message is not None:
+                    if self.recorder is not None:
+                        self.recorder.add_leds(message)
+                    return self.uart.write(message)
         return None
 
     def readline(self):
@@ -109,6 +128,9 @@ class serialreader(threading.Thread):
                     self.uart.write(b'\xaaU\xaaU\xaaU\xaaU')
                     time.sleep(1)
                     self.uart.write(b'\x00\x00\x00\x00\x00\x00\x00\x00')
+                    self.leds.reset()
+                    if self.recorder is None:
+                        self.recorder = session_recorder.open_recorder(serialport)
                     self.connected = True
                 except Exception as e:
                     logging.info(f'ERROR: Cannot open serial port {serialport}: {str(e)}')
@@ -119,13 +141,15 @@ class serialreader(threading.Thread):
                     while True:
                         # logging.debug(f'serial data pending')
                         raw_message = self.readline()
+                        if self.recorder is not None:
+                            self.recorder.add_line(raw_message)
                         try:
-                            message = raw_message.decode("ascii")[1: -3]
-                            if len(message.split(" ")) == 320:  # 64*5
-                                self.handler(message)
-                            message = ""
+                            frame = frames.parse_frame(raw_message)
+                            if frame is not None:
+                                self.handler(frame)
                         except Exception as e:
                             logging.info(f'Exception during message decode: {str(e)}')
+                        self.flush_leds()
                 except Exception as e:
                     logging.info(f'Exception during serial communication: {str(e)}')
                     self.connected = False
@@ -0,0 +1,212 @@
+"""
+asyncio transport for the board link, as an alternative to the serialreader and usbtool threads.
+
+The same BoardProtocol works over a serial port or pty (read with loop.add_reader, posix only) and over
+TCP (e.g., a bluetooth bridge relaying the raw board lines). Decoded frames are passed to a callback, and
+led frames are sent through a led scheduler with an awaitable send_leds, so several boards, the lichess
+client or a web server can share one event loop:
+
+    reader = BoardReader(address, queue=queue.Queue())
+    transport, board = await aio_transport.connect(address, reader.update)
+    await board.send_leds(led_encoding.encode('e2e4'))
+"""
+import asyncio
+import logging
+import os
+
+from utils.logger import cfg
+from utils import frames, led_scheduler
+
+
+class BoardProtocol(asyncio.Protocol):
+    def __init__(self, on_frame, on_connection_lost=None):
+        self.on_frame = on_frame
+        self.on_connection_lost = on_connection_lost
+        self.transport = None
+        self.frame_buffer = frames.FrameBuffer()
+        self.leds = led_scheduler.LedScheduler()
+        self.paused = False
+        self.drain_waiters = []
+        self.closed = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.closed = asyncio.get_running_loop().create_future()
+        self.frame_buffer.clear()
+        self.leds.reset()
+
+    def data_received(self, data):
+        self.frame_buffer.feed(data)
+        # Only the newest complete reading matters, older ones in the same chunk are stale
+        for line in reversed(self.frame_buffer.pop_lines()):
+            frame = frames.parse_frame(line)
+            if frame is not None:
+                try:
+                    self.on_frame(frame)
+                except Exception:
+                    logging.exception('BoardProtocol: frame callback failed')
+                break
+
+    def connection_lost(self, exc):
+        logging.info(f'BoardProtocol: connection lost {exc or ""}')
+        self.transport = None
+        self.resume_writing()
+        if self.closed is not None and not self.closed.done():
+            self.closed.set_result(exc)
+        if self.on_connection_lost is not None:
+            self.on_connection_lost(exc)
+
+    def pause_writing(self):
+        self.paused = True
+
+    def resume_writing(self):
+        self.paused = False
+        for waiter in self.drain_waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+        self.drain_waiters.clear()
+
+    async def drain(self):
+        if self.paused:
+            waiter = asyncio.get_running_loop().create_future()
+            self.drain_waiters.append(waiter)
+            await waiter
+
+    async def send_leds(self, frame, priority=led_scheduler.PRIORITY_NORMAL):
+        """
+        Sends a led frame, waiting while the link is rate limited. Returns once the frame was handed to
+        the transport, or was superseded by a newer frame, or was already shown.
+        """
+        self.leds.submit(frame, priority)
+        while self.transport is not None:
+            wait = self.leds.time_until_ready()
+            if wait is None:
+                break
+            if wait > 0:
+                await asyncio.sleep(wait)
+                continue
+            frame = self.leds.next_frame()
+            if frame is not None:
+                if cfg.DEBUG_LED:
+                    logging.debug(f'BoardProtocol: sending to board - {list(frame)}')
+                self.transport.write(frame)
+        await self.drain()
+
+
+class SerialTransport(asyncio.Transport):
+    """
+    Non blocking transport over a serial port or pty file descriptor
+    """
+
+    def __init__(self, loop, fd, protocol):
+        super().__init__()
+        self.loop = loop
+        self.fd = fd
+        self.protocol = protocol
+        self.buffer = bytearray()
+        self.closing = False
+        loop.add_reader(fd, self.read_ready)
+        loop.call_soon(protocol.connection_made, self)
+
+    def read_ready(self):
+        try:
+            data = os.read(self.fd, 4096)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError as e:
+            self.close(e)
+            return
+        if data:
+            self.protocol.data_received(data)
+        else:
+            self.close()
+
+    def write(self, data):
+        if self.closing:
+            return
+        if self.buffer:
+            self.buffer += data
+            return
+        try:
+            n = os.write(self.fd, data)
+        except (BlockingIOError, InterruptedError):
+            n = 0
+        except OSError as e:
+            self.close(e)
+            return
+        if n < len(data):
+            self.buffer += data[n:]
+            self.loop.add_writer(self.fd, self.write_ready)
+            self.protocol.pause_writing()
+
+    def write_ready(self):
+        try:
+            n = os.write(self.fd, self.buffer)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError as e:
+            self.close(e)
+            return
+        del self.buffer[:n]
+        if not self.buffer:
+            self.loop.remove_writer(self.fd)
+            self.protocol.resume_writing()
+
+    def get_write_buffer_size(self):
+        return len(self.buffer)
+
+    def is_closing(self):
+        return self.closing
+
+    def close(self, exc=None):
+        if self.closing:
+            return
+        self.closing = True
+        self.loop.remove_reader(self.fd)
+        self.loop.remove_writer(self.fd)
+        os.close(self.fd)
+        self.loop.call_soon(self.protocol.connection_lost, exc)
+
+
+def open_serial_fd(path, baudrate=38400):
+    # posix only, imported here so that the module (and TCP connections) also work on Windows
+    import termios
+    import tty
+
+    fd = os.open(path, os.O_RDWR | os.O_NOCTTY | os.O_NONBLOCK)
+    if os.isatty(fd):
+        tty.setraw(fd)
+        attributes = termios.tcgetattr(fd)
+        speed = getattr(termios, f'B{baudrate}')
+        attributes[4] = attributes[5] = speed  # ispeed, ospeed
+        termios.tcsetattr(fd, termios.TCSANOW, attributes)
+    return fd
+
+
+async def open_serial(path, on_frame, baudrate=38400, on_connection_lost=None):
+    """
+    Connects to a board on a serial port or pty, returns (transport, protocol)
+    """
+    loop = asyncio.get_running_loop()
+    protocol = BoardProtocol(on_frame, on_connection_lost)
+    transport = SerialTransport(loop, open_serial_fd(path, baudrate), protocol)
+    await asyncio.sleep(0)  # let connection_made run
+    return transport, protocol
+
+
+async def open_tcp(host, port, on_frame, on_connection_lost=None):
+    """
+    Connects to a board relayed over TCP, returns (transport, protocol)
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.create_connection(lambda: BoardProtocol(on_frame, on_connection_lost), host, port)
+
+
+async def connect(address, on_frame, on_connection_lost=None):
+    """
+    Connects to 'host:port' over TCP, or to a serial device path otherwise
+    """
+    host, _, port = address.rpartition(':')
+    if host and port.isdigit() and not address.startswith('/'):
+        return await open_tcp(host, int(port), on_frame, on_connection_lost)
+    return await open_serial(address, on_frame, on_connection_lost=on_connection_lost)
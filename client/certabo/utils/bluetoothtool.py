@@ -8,7 +8,7 @@ import time
 import bluetooth
 
 import cfg
-from utils import usbtool
+from utils import usbtool, frames, led_scheduler
 
 
 def _bluetothtool(address_chessboard, queue_to_usbtool, queue_from_usbtool):
@@ -17,6 +17,7 @@ def _bluetothtool(address_chessboard, queue_to_usbtool, queue_from_usbtool):
     socket = None
     socket_ok = False
     first_connection = True
+    frame_buffer = frames.FrameBuffer()
 
     while True:
         time.sleep(.001)
@@ -33,6 +34,7 @@ def _bluetothtool(address_chessboard, queue_to_usbtool, queue_from_usbtool):
 
                 socket = bluetooth.BluetoothSocket(bluetooth.RFCOMM)
                 socket.connect((address_chessboard, cfg.BTPORT))
+                frame_buffer.clear()
 
             except Exception as e:
                 logging.warning(f'Failed to (re)connect to port {address_chessboard}: {e}')
@@ -47,7 +49,7 @@ def _bluetothtool(address_chessboard, queue_to_usbtool, queue_from_usbtool):
 
         # Write led info
         try:
-            new_message = queue_to_usbtool.get_nowait()
+            _, new_message, _ = led_scheduler.unpack(queue_to_usbtool.get_nowait())
             socket.send(new_message)
         except queue.Empty:
             pass
@@ -60,13 +62,17 @@ def _bluetothtool(address_chessboard, queue_to_usbtool, queue_from_usbtool):
         readable, _, _ = select.select(socket_list, [], [], 0)
         if readable:
             try:
-                data = socket.recv(1024).decode('utf-8')
+                data = socket.recv(4096)
                 # If no data, port is probably closed
                 if not data:
                     print('Lost connection to device: no data')
                     socket_ok = False
                     continue
-                queue_from_usbtool.put(data)
+                frame_buffer.feed(data)
+                for line in frame_buffer.pop_lines():
+                    frame = frames.parse_frame(line)
+                    if frame is not None:
+                        queue_from_usbtool.put(frame)
             except bluetooth.btcommon.BluetoothError as e:
                 print("Lost connection to device:", e)
                 socket_ok = False
@@ -0,0 +1,51 @@
+"""
+Squares that differ between two boards, computed from python-chess bitboards.
+
+Each board is described by 8 bitboards (one per piece type and one per color), so the squares whose
+contents differ are found with 8 XORs instead of comparing piece_at for every square. Board FENs read
+from the board repeat for many frames, so parsed boards and diffs are memoized.
+"""
+from functools import lru_cache
+
+import chess
+
+
+def placement(board):
+    """
+    Bitboards describing the pieces of a chess.BaseBoard
+    """
+    return (board.pawns, board.knights, board.bishops, board.rooks, board.queens, board.kings,
+            board.occupied_co[chess.WHITE], board.occupied_co[chess.BLACK])
+
+
+def changed_mask(board, other):
+    """
+    Mask of the squares whose contents differ between two boards
+    """
+    mask = chess.BB_EMPTY
+    for bb, other_bb in zip(placement(board), placement(other)):
+        mask |= bb ^ other_bb
+    return mask
+
+
+@lru_cache(maxsize=64)
+def placement_from_fen(board_fen):
+    """
+    Bitboards of a board FEN (or full FEN), raises ValueError if it is not valid
+    """
+    return placement(chess.BaseBoard(board_fen.split()[0]))
+
+
+@lru_cache(maxsize=256)
+def diff_fens(board_fen, other_fen):
+    """
+    Mask of the squares whose contents differ between two board FENs (full FENs are accepted too)
+    """
+    mask = chess.BB_EMPTY
+    for bb, other_bb in zip(placement_from_fen(board_fen), placement_from_fen(other_fen)):
+        mask |= bb ^ other_bb
+    return mask
+
+
+def diff_squareset(board_fen, other_fen):
+    return chess.SquareSet(diff_fens(board_fen, other_fen))
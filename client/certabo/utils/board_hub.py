@@ -0,0 +1,292 @@
+"""
+Serves several Certabo boards from a single thread.
+
+Every board gets its own serial port, line buffer, BoardReader (with its own calibration file and reading
+filter) and led scheduler, while one selectors loop waits on all the ports at once. Readings are decoded in
+the hub thread, so consumers follow a board through BoardReader events:
+
+    hub = BoardHub()
+    hub.discover()
+    hub.subscribe('/dev/ttyUSB0', lambda event: print(event.fen))
+    hub.start()
+
+Serial ports can only be selected on posix systems.
+"""
+import logging
+import queue
+import selectors
+import socket
+import threading
+import time
+
+import serial
+
+from utils.logger import cfg
+from utils import frames, led_scheduler, usbtool
+from utils.reader_writer import BoardReader
+
+
+class BoardStats:
+    def __init__(self):
+        self.started = time.monotonic()
+        self.bytes = 0
+        self.readings = 0
+        self.stale_readings = 0
+        self.invalid_lines = 0
+        self.leds_sent = 0
+        self.errors = 0
+        self.reconnects = 0
+        self.last_reading = None
+        self.reading_interval = None  # seconds, exponentially averaged
+        self.decode_time = None  # seconds from serial data to updated board, exponentially averaged
+
+    def add_reading(self, now, decode_time):
+        if self.last_reading is not None:
+            interval = now - self.last_reading
+            self.reading_interval = interval if self.reading_interval is None else .9 * self.reading_interval + .1 * interval
+        self.decode_time = decode_time if self.decode_time is None else .9 * self.decode_time + .1 * decode_time
+        self.last_reading = now
+        self.readings += 1
+
+    def as_dict(self):
+        elapsed = max(time.monotonic() - self.started, 1e-9)
+        return {
+            'bytes': self.bytes,
+            'readings': self.readings,
+            'readings_per_second': self.readings / elapsed,
+            'bytes_per_second': self.bytes / elapsed,
+            'stale_readings': self.stale_readings,
+            'invalid_lines': self.invalid_lines,
+            'leds_sent': self.leds_sent,
+            'errors': self.errors,
+            'reconnects': self.reconnects,
+            'reading_interval_ms': None if self.reading_interval is None else self.reading_interval * 1000,
+            'decode_time_ms': None if self.decode_time is None else self.decode_time * 1000,
+        }
+
+
+class Board:
+    def __init__(self, address, reading_filter=None):
+        self.address = address
+        self.port = None
+        self.frame_buffer = frames.FrameBuffer()
+        self.reader = BoardReader(address, reading_filter, queue=queue.Queue(maxsize=64))
+        self.leds = led_scheduler.LedScheduler()
+        self.stats = BoardStats()
+
+    @property
+    def connected(self):
+        return self.port is not None
+
+
+class BoardHub:
+    def __init__(self, reading_filter_factory=None, reconnect_interval=2):
+        """
+        reading_filter_factory is called once per board to create its reading filter (see utils.reading_filter)
+        """
+        self.reading_filter_factory = reading_filter_factory
+        self.reconnect_interval = reconnect_interval
+        self.boards = {}
+        self.selector = selectors.DefaultSelector()
+        # send_leds writes a byte here to wake the hub thread up, so led frames don't wait for the select timeout
+        self.wakeup_reader, self.wakeup_writer = socket.socketpair()
+        self.wakeup_reader.setblocking(False)
+        self.wakeup_writer.setblocking(False)
+        self.selector.register(self.wakeup_reader, selectors.EVENT_READ, None)
+        self.lock = threading.Lock()
+        self.thread = None
+        self.running = False
+        self.closed = False
+        self.last_reconnect = 0
+
+    def discover(self):
+        """
+        Adds every available Certabo board that is not served yet, returns their addresses
+        """
+        new_addresses = [address for address in usbtool.find_addresses() if address not in self.boards]
+        for address in new_addresses:
+            self.add_board(address)
+        return new_addresses
+
+    def add_board(self, address):
+        with self.lock:
+            if address in self.boards:
+                return self.boards[address]
+            reading_filter = self.reading_filter_factory() if self.reading_filter_factory is not None else None
+            board = Board(address, reading_filter)
+            self.boards[address] = board
+        self.open(board)
+        logging.info(f'BoardHub: serving {address}')
+        return board
+
+    def remove_board(self, address):
+        with self.lock:
+            board = self.boards.pop(address, None)
+        if board is not None:
+            self.close(board)
+
+    def reader(self, address):
+        return self.boards[address].reader
+
+    def subscribe(self, address, subscriber=None, maxsize=0):
+        """
+        Subscribes to the BoardChanged events of one board, see BoardReader.subscribe
+        """
+        return self.boards[address].reader.subscribe(subscriber, maxsize)
+
+    def send_leds(self, address, frame, priority=led_scheduler.PRIORITY_NORMAL):
+        """
+        Queues a led frame for a board and wakes the hub thread up to write it
+        """
+        self.boards[address].leds.submit(frame, priority)
+        self.wakeup()
+
+    def wakeup(self):
+        try:
+            self.wakeup_writer.send(b'\0')
+        except (BlockingIOError, OSError):  # Already woken up, or closed
+            pass
+
+    def drain_wakeup(self):
+        try:
+            while self.wakeup_reader.recv(4096):
+                pass
+        except (BlockingIOError, OSError):
+            pass
+
+    def stats(self):
+        return {address: board.stats.as_dict() for address, board in list(self.boards.items())}
+
+    def log_stats(self):
+        for address, stats in self.stats().items():
+            logging.info(f'BoardHub: {address} - {stats}')
+
+    def open(self, board):
+        try:
+            port = serial.Serial(board.address, 38400, timeout=0)
+            self.selector.register(port.fileno(), selectors.EVENT_READ, board)
+        except (serial.SerialException, OSError, ValueError) as e:
+            logging.warning(f'BoardHub: failed to open {board.address}: {e}')
+            board.stats.errors += 1
+            return False
+        board.port = port
+        board.frame_buffer.clear()
+        board.leds.reset()
+        return True
+
+    def close(self, board):
+        if board.port is None:
+            return
+        try:
+            self.selector.unregister(board.port.fileno())
+        except (KeyError, ValueError, OSError):
+            pass
+        try:
+            board.port.close()
+        except Exception:
+            pass
+        board.port = None
+
+    def fail(self, board, error):
+        logging.warning(f'BoardHub: lost {board.address}: {error}')
+        board.stats.errors += 1
+        self.close(board)
+
+    def read(self, board):
+        try:
+            data = board.port.read(max(1, board.port.in_waiting))
+        except Exception as e:
+            self.fail(board, e)
+            return
+        if not data:
+            return
+
+        received = time.monotonic()
+        board.stats.bytes += len(data)
+        board.frame_buffer.feed(data)
+        lines = board.frame_buffer.pop_lines()
+        # As in usbtool, only the newest complete reading matters
+        for n, line in enumerate(reversed(lines)):
+            frame = frames.parse_frame(line)
+            if frame is None:
+                board.stats.invalid_lines += 1
+                continue
+            board.stats.stale_readings += len(lines) - n - 1
+            board.reader.update(frame)
+            now = time.monotonic()
+            board.stats.add_reading(now, now - received)
+            break
+
+    def write_leds(self, board):
+        frame = board.leds.next_frame()
+        if frame is None:
+            return
+        try:
+            board.port.write(frame)
+        except Exception as e:
+            self.fail(board, e)
+            return
+        board.stats.leds_sent += 1
+        if cfg.DEBUG_LED:
+            logging.debug(f'BoardHub: sending to {board.address} - {list(frame)}')
+
+    def reconnect(self):
+        now = time.monotonic()
+        if now - self.last_reconnect < self.reconnect_interval:
+            return
+        self.last_reconnect = now
+        for board in list(self.boards.values()):
+            if not board.connected and self.open(board):
+                board.stats.reconnects += 1
+                logging.info(f'BoardHub: reconnected {board.address}')
+
+    def run_once(self, timeout=.05):
+        """
+        Waits up to timeout seconds for data on any port and processes it, then writes pending led frames
+        """
+        boards = [board for board in list(self.boards.values()) if board.connected]
+        # Wake up in time for rate limited led frames
+        for board in boards:
+            wait = board.leds.time_until_ready()
+            if wait is not None:
+                timeout = min(timeout, wait)
+
+        for key, _ in self.selector.select(timeout):
+            if key.data is None:
+                self.drain_wakeup()
+            else:
+                self.read(key.data)
+
+        for board in boards:
+            if board.connected:
+                self.write_leds(board)
+        self.reconnect()
+
+    def run(self):
+        self.running = True
+        while self.running:
+            self.run_once()
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        return self.thread
+
+    def stop(self):
+        """
+        Stops the hub thread and closes every port, the hub cannot be started again. Later calls do nothing.
+        """
+        if self.closed:
+            return
+        self.closed = True
+        self.running = False
+        self.wakeup()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        for board in list(self.boards.values()):
+            self.close(board)
+        self.selector.unregister(self.wakeup_reader)
+        self.selector.close()
+        self.wakeup_reader.close()
+        self.wakeup_writer.close()
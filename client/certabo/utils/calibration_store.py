@@ -0,0 +1,163 @@
+"""
+Binary storage of the piece calibration (RFID code of every piece).
+
+Layout, all integers big endian:
+
+    header:   b'CRTB', version (1 byte), number of boards (2 bytes)
+    board:    name length (1 byte), name (utf-8), number of records (4 bytes)
+    record:   piece letter (1 byte, e.g. b'q'), code (5 bytes)
+
+Records have a fixed width, so a board loads straight into the code -> piece index with a single read.
+One file can hold the calibration of several boards. Files are replaced atomically, and calibration
+files written by older versions (pickles) are still read, but without executing anything they contain.
+"""
+import io
+import logging
+import os
+import pickle
+import struct
+import tempfile
+
+MAGIC = b'CRTB'
+VERSION = 1
+DEFAULT_BOARD = 'default'
+PIECE_ORDER = ('p', 'r', 'n', 'b', 'k', 'q', 'P', 'R', 'N', 'B', 'K', 'Q')  # order of the legacy pickles
+
+HEADER = struct.Struct('>4sBH')
+COUNT = struct.Struct('>I')
+RECORD_LENGTH = 6
+
+
+class RestrictedUnpickler(pickle.Unpickler):
+    """
+    Legacy calibrations are plain lists of numbers or strings, any reference to a class or function is refused
+    """
+
+    def find_class(self, module, name):
+        raise pickle.UnpicklingError(f'Calibration file refers to {module}.{name}')
+
+
+def empty_calibration():
+    return {letter: [] for letter in PIECE_ORDER}
+
+
+def to_code(code):
+    """
+    Converts a code given as 5 ints (or numeric strings, as in old calibration files) to bytes
+    """
+    return bytes(int(c) for c in code)
+
+
+def decode(data):
+    """
+    Parses the contents of a calibration file into {board name: {piece letter: [5 byte codes]}}.
+    Raises ValueError if the contents are corrupt.
+    """
+    if not data.startswith(MAGIC):
+        return {DEFAULT_BOARD: decode_legacy(data)}
+
+    view = memoryview(data)
+    try:
+        _, version, n_boards = HEADER.unpack_from(view)
+        if version > VERSION:
+            raise ValueError(f'Calibration format version {version} is not supported')
+        offset = HEADER.size
+        boards = {}
+        for _ in range(n_boards):
+            name_length = view[offset]
+            name = bytes(view[offset + 1: offset + 1 + name_length]).decode('utf-8')
+            offset += 1 + name_length
+            n_records, = COUNT.unpack_from(view, offset)
+            offset += COUNT.size
+
+            end = offset + n_records * RECORD_LENGTH
+            if end > len(view):
+                raise ValueError('Calibration file is truncated')
+            calibration = empty_calibration()
+            for start in range(offset, end, RECORD_LENGTH):
+                letter = chr(view[start])
+                calibration[letter].append(bytes(view[start + 1: start + RECORD_LENGTH]))
+            boards[name] = calibration
+            offset = end
+    except (struct.error, IndexError, KeyError, UnicodeDecodeError) as e:
+        raise ValueError(f'Corrupt calibration file: {e}')
+    return boards
+
+
+def decode_legacy(data):
+    try:
+        pieces = RestrictedUnpickler(io.BytesIO(data)).load()
+    except Exception as e:
+        raise ValueError(f'Cannot read calibration file: {e}')
+
+    calibration = empty_calibration()
+    # A fresh file only holds an empty dict
+    if pieces:
+        for letter, piece_codes in zip(PIECE_ORDER, pieces):
+            calibration[letter] = [to_code(code) for code in piece_codes]
+    return calibration
+
+
+def encode(boards):
+    chunks = [HEADER.pack(MAGIC, VERSION, len(boards))]
+    for name, calibration in boards.items():
+        name = name.encode('utf-8')
+        records = [letter.encode('ascii') + to_code(code)
+                   for letter in PIECE_ORDER for code in calibration.get(letter, ())]
+        chunks.append(bytes([len(name)]) + name + COUNT.pack(len(records)))
+        chunks.extend(records)
+    return b''.join(chunks)
+
+
+def load_all(path):
+    """
+    Returns the calibration of every board in the file. Raises OSError if it can not be read and
+    ValueError if it is corrupt.
+    """
+    with open(path, 'rb') as f:
+        return decode(f.read())
+
+
+def load(path, board=DEFAULT_BOARD):
+    """
+    Returns {piece letter: [5 byte codes]} for one board, empty lists if the board is not in the file
+    """
+    return load_all(path).get(board, empty_calibration())
+
+
+def load_index(path, board=DEFAULT_BOARD):
+    """
+    Returns the {5 byte code: piece letter} index of one board. When a code was calibrated for two
+    pieces the latter in PIECE_ORDER wins.
+    """
+    return {code: letter for letter, codes in load(path, board).items() for code in codes}
+
+
+def save(path, calibration, board=DEFAULT_BOARD):
+    """
+    Stores the calibration ({piece letter: codes}) of one board, keeping the other boards in the file.
+    The file is written to a temporary file first and then swapped in, so it is never left half written.
+    """
+    boards = {}
+    if os.path.exists(path):
+        try:
+            boards = load_all(path)
+        except (OSError, ValueError) as e:
+            logging.warning(f'Overwriting unreadable calibration file {path}: {e}')
+    boards[board] = calibration
+    data = encode(boards)
+
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.calibration-', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
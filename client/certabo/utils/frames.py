@@ -0,0 +1,108 @@
+"""
+Parsing of the raw readings sent by the Certabo board.
+
+Each line looks like b':12 0 34 0 0 ... 5 \r\n' and holds 5 values for each of the 64 squares,
+starting at a8. Lines are parsed straight from bytes into a 320 byte frame, so the code of a
+square is simply frame[n_cell * 5: n_cell * 5 + 5] and can be used as a dictionary key.
+"""
+
+CODE_LENGTH = 5
+FRAME_LENGTH = 64 * CODE_LENGTH
+EMPTY_CODE = bytes(CODE_LENGTH)
+
+
+def parse_frame(line):
+    """
+    Converts a raw board line into a 320 byte frame.
+
+    Accepts bytes, bytearray or memoryview as read from the serial port, and str for data
+    relayed by the bluetooth server. Returns None if the line is incomplete or corrupt.
+    """
+    if isinstance(line, str):
+        line = line.encode('ascii', 'replace')
+    elif isinstance(line, memoryview):
+        line = line.tobytes()
+
+    # split() without arguments also drops the trailing ' \r\n'
+    values = line.lstrip(b':').split()
+    if len(values) != FRAME_LENGTH:
+        return None
+    try:
+        return bytes(map(int, values))
+    except ValueError:  # Not a number or larger than 255
+        return None
+
+
+def format_frame(frame):
+    """
+    Converts a frame back to the line format sent by the board (e.g., to forward it over bluetooth)
+    """
+    return b':' + b' '.join(b'%d' % value for value in frame) + b' \r\n'
+
+
+def cell_code(frame, n_cell):
+    """
+    Returns the 5 byte code of a cell (0 is a8, 63 is h1)
+    """
+    return frame[n_cell * CODE_LENGTH: n_cell * CODE_LENGTH + CODE_LENGTH]
+
+
+def diff_cells(old_frame, new_frame):
+    """
+    Returns the set of cells whose codes differ between two frames (all cells if old_frame is None)
+    """
+    if old_frame is None:
+        return set(range(64))
+
+    # XOR both frames as 2560 bit integers and walk down the set bits, one cell at a time
+    diff = int.from_bytes(old_frame, 'big') ^ int.from_bytes(new_frame, 'big')
+    cells = set()
+    while diff:
+        n_cell = (FRAME_LENGTH - 1 - (diff.bit_length() - 1) // 8) // CODE_LENGTH
+        cells.add(n_cell)
+        # Clear the bits of this cell and every cell before it
+        diff &= (1 << (FRAME_LENGTH - CODE_LENGTH * (n_cell + 1)) * 8) - 1
+    return cells
+
+
+class FrameBuffer:
+    """
+    Collects raw data read in bulk from the board and splits it into complete lines.
+
+    Data is appended to a bytearray and consumed lines are deleted from its front, which
+    CPython does in place without copying the remaining bytes.
+    """
+
+    def __init__(self, max_size=16 * 1024):
+        self.buf = bytearray()
+        self.max_size = max_size
+
+    def feed(self, data):
+        self.buf += data
+        if len(self.buf) > self.max_size:
+            # After a backlog only the newest complete line (and the partial one after it) matters
+            last = self.buf.rfind(b'\n')
+            # A board line is ~1.2kB, anything much longer without a newline is garbage
+            if last < 0 or len(self.buf) - last > self.max_size:
+                del self.buf[:-FRAME_LENGTH * 4]
+            else:
+                del self.buf[:self.buf.rfind(b'\n', 0, last) + 1]
+
+    def pop_lines(self):
+        """
+        Returns all complete lines, keeping any partial line for the next feed
+        """
+        lines = []
+        start = 0
+        while True:
+            end = self.buf.find(b'\n', start)
+            if end < 0:
+                break
+            lines.append(bytes(self.buf[start:end + 1]))
+            start = end + 1
+        if start:
+            del self.buf[:start]
+        return lines
+
+    def clear(self):
+        self.buf.clear()
@@ -1,49 +1,146 @@
 import logging
+import time
+from collections import OrderedDict
+
+from utils import move_inference
+from utils.logger import cfg
+
+
+class MoveCache:
+    """
+    Results of move detection for the physical placements read while the virtual board is in one position.
+
+    Entries are keyed on the physical FEN, dropped least recently used first once max_size is reached,
+    and ignored once older than ttl seconds. The whole cache is cleared when the virtual board reaches
+    a new position. Counters are kept for the whole game (see reset_move_cache) and logged when cfg.DEBUG_READING is set.
+    """
+
+    def __init__(self, max_size=256, ttl=120):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()  # key -> (timestamp, result)
+        self.position = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def set_position(self, position):
+        """
+        Clears the cache if the virtual board is not in the same position (see position_key) as before
+        """
+        if position != self.position:
+            if self.entries and cfg.DEBUG_READING:
+                self.log_stats()
+            self.clear()
+            self.position = position
+
+    def get(self, key):
+        """
+        Returns the cached result or raises KeyError
+        """
+        try:
+            timestamp, result = self.entries[key]
+        except KeyError:
+            self.misses += 1
+            raise
+
+        if time.monotonic() - timestamp > self.ttl:
+            del self.entries[key]
+            self.expirations += 1
+            self.misses += 1
+            raise KeyError(key)
+
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return result
+
+    def put(self, key, result):
+        self.entries[key] = (time.monotonic(), result)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self):
+        self.entries.clear()
+
+    def reset(self):
+        self.clear()
+        self.position = None
+        self.hits = self.misses = self.evictions = self.expirations = 0
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self.entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+            'hit_rate': self.hits / lookups if lookups else 0,
+        }
+
+    def log_stats(self):
+        stats = self.stats()
+        logging.debug('Move cache: {size} entries, {hits} hits, {misses} misses ({hit_rate:.0%} hit rate), '
+                      '{evictions} evictions, {expirations} expirations'.format(**stats))
+
+
+def find_moves(virtual_board, physical_fen, check_double_moves=False):
+    physical_board = move_inference.to_base_board(physical_fen)
+    if physical_board is None:
+        return []
+
+    moves = move_inference.infer_moves(virtual_board, physical_board)
+    if len(moves) > 1:
+        # Keep the first one, as a search over the legal moves would
+        logging.debug('Ambiguous move - {}'.format(', '.join(move.uci() for move in moves)))
+    if moves:
+        return [moves[0].uci()]
+
+    if check_double_moves:
+        pairs = move_inference.infer_double_moves(virtual_board, physical_board)
+        if pairs:
+            return [pairs[0][0].uci(), pairs[0][1].uci()]
+    return []
+
+
+def position_key(board):
+    """
+    Everything that determines the legal moves of a position
+    """
+    return board.board_fen(), board.turn, board.castling_rights, board.ep_square
 
-from lru import LRU
 
 # TODO: Make this part of usbreader?
-get_moves_cache = LRU(8)
+move_cache = MoveCache()
+def reset_move_cache():
+    """
+    Starts the move cache and its counters over, called for every new game
+    """
+    if cfg.DEBUG_READING:
+        move_cache.log_stats()
+    move_cache.reset()
+
+
 def get_moves(virtual_board, physical_fen, check_double_moves=False):
-    virtual_fen = virtual_board.board_fen()
-    caching_key = (virtual_fen, physical_fen, check_double_moves)
+    move_cache.set_position(position_key(virtual_board))
+    caching_key = ('moves', physical_fen, check_double_moves)
     try:
-        return get_moves_cache[caching_key]
+        result = move_cache.get(caching_key)
     except KeyError:
-        pass
-
-    copy_board = virtual_board.copy()
-    moves = list(virtual_board.generate_legal_moves())
-    for move in moves:
-        copy_board.push(move)
-        if physical_fen == copy_board.board_fen():
-            logging.debug('Single move detected - {}'.format(move.uci()))
-            result = [move.uci()]
-            get_moves_cache[caching_key] = result
-            return result
-        copy_board.pop()
+        result = find_moves(virtual_board, physical_fen, check_double_moves)
+        move_cache.put(caching_key, result)
 
-    if check_double_moves:
-        for move in moves:
-            copy_board.push(move)
-            legal_moves2 = list(copy_board.generate_legal_moves())
-            for move2 in legal_moves2:
-                copy_board.push(move2)
-                if physical_fen == copy_board.board_fen():
-                    logging.debug('Double move detected - {}, {}'.format(move.uci(), move2.uci()))
-                    result = [move.uci(), move2.uci()]
-                    get_moves_cache[caching_key] = result
-                    return result
-                copy_board.pop()
-            copy_board.pop()
-
-    result = []
-    get_moves_cache[caching_key] = result
+    if len(result) == 1:
+        logging.debug('Single move detected - {}'.format(result[0]))
+    elif len(result) == 2:
+        logging.debug('Double move detected - {}, {}'.format(*result))
     return result
 
 
 # TODO: Allow double move back for human games
-is_move_back_cache = LRU(8)
 def is_move_back(virtual_board, physical_fen):
     """
     Check if physical fen correspondts to virtual_board with a move back
@@ -51,10 +148,11 @@ def is_move_back(virtual_board, physical_fen):
     :param physical_fen:
     :return:
     """
-    virtual_fen = virtual_board.board_fen()
-    caching_key = (virtual_fen, physical_fen)
+    move_cache.set_position(position_key(virtual_board))
+    last_move = virtual_board.move_stack[-1] if virtual_board.move_stack else None
+    caching_key = ('back', physical_fen, last_move)
     try:
-        return is_move_back_cache[caching_key]
+        return move_cache.get(caching_key)
     except KeyError:
         pass
 
@@ -68,5 +166,5 @@ def is_move_back(virtual_board, physical_fen):
         if temp_board.board_fen() == physical_fen:
             result = True
 
-    is_move_back_cache[caching_key] = result
-    return result
\ No newline at end of file
+    move_cache.put(caching_key, result)
+    return result
@@ -0,0 +1,132 @@
+"""
+Led animations, compiled once into sequences of (frame, duration) steps and played by a single thread.
+
+Frames go out through the same path as any other led message (usbtool queue or serial thread), so
+steps are kept at or above the led scheduler interval (see utils.led_scheduler) to avoid being coalesced.
+"""
+import logging
+import threading
+import time
+
+import chess
+
+from utils.led_encoding import EMPTY_FRAME, mask_to_frame, SQUARE_MASKS, SQUARE_MASKS_ROTATED
+from utils.led_scheduler import PRIORITY_NORMAL
+from utils.logger import cfg
+
+FULL_FRAME = bytes([255] * 8)
+
+
+class Animation:
+    def __init__(self, steps, repeat=1):
+        """
+        steps is a sequence of (frame, duration in seconds), played repeat times (forever if None)
+        """
+        self.steps = tuple(steps)
+        self.repeat = repeat
+
+    def __iter__(self):
+        n = 0
+        while self.repeat is None or n < self.repeat:
+            yield from self.steps
+            n += 1
+
+
+def flash(frame, period=1., repeat=None):
+    """
+    Frame on and off every period seconds
+    """
+    return Animation(((frame, period), (EMPTY_FRAME, period)), repeat)
+
+
+def pulse(frame, beat=.2, pause=.8, repeat=None):
+    """
+    Two short blinks followed by a pause, used for a king in check
+    """
+    return Animation(((frame, beat), (EMPTY_FRAME, beat), (frame, beat), (EMPTY_FRAME, pause)), repeat)
+
+
+def sweep(step=.2, rotate180=False, repeat=1):
+    """
+    Lights one rank after the other, starting from the player's side
+    """
+    masks = SQUARE_MASKS_ROTATED if rotate180 else SQUARE_MASKS
+    steps = []
+    for rank in range(8):
+        mask = 0
+        for file in range(8):
+            mask |= masks[chess.square(file, rank)]
+        steps.append((mask_to_frame(mask), step))
+    return Animation(steps, repeat)
+
+
+def game_over(frame=FULL_FRAME, rotate180=False):
+    """
+    Sweep over the board followed by two flashes of frame, ending with the leds off
+    """
+    steps = list(sweep(rotate180=rotate180).steps)
+    steps.extend(((frame, .5), (EMPTY_FRAME, .5), (frame, .5), (EMPTY_FRAME, .5)))
+    return Animation(steps)
+
+
+class LedAnimator:
+    """
+    Plays one animation at a time in a background thread, calling send(frame, priority, replace) for every step.
+    Playing a new animation or stopping replaces the current one; once stop returns no frame of the
+    stopped animation is sent anymore. The first frame of an animation replaces the frames still pending.
+    """
+
+    def __init__(self, send):
+        self.send = send
+        self.condition = threading.Condition()
+        self.animation = None
+        self.priority = PRIORITY_NORMAL
+        self.generation = 0
+        self.thread = None
+
+    @property
+    def running(self):
+        return self.animation is not None
+
+    def play(self, animation, priority=PRIORITY_NORMAL):
+        with self.condition:
+            self.animation = animation
+            self.priority = priority
+            self.generation += 1
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+            self.condition.notify()
+
+    def stop(self):
+        with self.condition:
+            if self.animation is not None:
+                self.animation = None
+                self.generation += 1
+                self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.animation is not None)
+                animation, priority, generation = self.animation, self.priority, self.generation
+
+            if cfg.DEBUG_LED:
+                logging.debug(f'LedAnimator: playing {len(animation.steps)} steps, repeat={animation.repeat}')
+
+            next_time = time.monotonic()
+            first = True
+            for frame, duration in animation:
+                with self.condition:
+                    # Sending while holding the lock keeps stale frames from following a stop
+                    if self.generation != generation:
+                        break
+                    self.send(frame, priority, first)
+                    first = False
+
+                    next_time += duration
+                    self.condition.wait_for(lambda: self.generation != generation, next_time - time.monotonic())
+            else:
+                with self.condition:
+                    if self.generation == generation:
+                        self.animation = None
@@ -0,0 +1,64 @@
+"""
+Encoding of squares into Certabo led frames.
+
+A frame is 8 bytes, one per rank starting with rank 8, with one bit per file (a is the lowest bit).
+That is exactly a python-chess square mask sent big endian, so frames are built by ORing precomputed
+square masks. With rotate180 the board is seen from black and square s lights the led of square 63 - s.
+"""
+from functools import lru_cache
+
+import chess
+
+SQUARE_MASKS = tuple(chess.BB_SQUARES)
+SQUARE_MASKS_ROTATED = tuple(chess.BB_SQUARES[63 - square] for square in chess.SQUARES)
+SQUARE_INDEX = {name: square for square, name in enumerate(chess.SQUARE_NAMES)}
+
+EMPTY_FRAME = bytes(8)
+
+
+def mask_to_frame(mask):
+    return mask.to_bytes(8, byteorder='big')
+
+
+def squares_mask(squares, rotate180=False):
+    """
+    Returns the led mask of squares, which can be:
+        a square name ('e2') or a move string ('e2e4', a promotion piece is ignored)
+        a chess.Move or a chess.SquareSet
+        an iterable of square names or square numbers
+    """
+    masks = SQUARE_MASKS_ROTATED if rotate180 else SQUARE_MASKS
+
+    if isinstance(squares, str):
+        if len(squares) < 4:
+            return masks[SQUARE_INDEX[squares]]
+        return masks[SQUARE_INDEX[squares[:2]]] | masks[SQUARE_INDEX[squares[2:4]]]
+
+    if isinstance(squares, chess.SquareSet):
+        mask = int(squares)
+        if rotate180:
+            mask = chess.flip_vertical(chess.flip_horizontal(mask))
+        return mask
+
+    if isinstance(squares, chess.Move):
+        return masks[squares.from_square] | masks[squares.to_square]
+
+    mask = 0
+    for square in squares:
+        mask |= masks[square if isinstance(square, int) else SQUARE_INDEX[square]]
+    return mask
+
+
+@lru_cache(maxsize=512)
+def _encode_string(squares, rotate180):
+    return mask_to_frame(squares_mask(squares, rotate180))
+
+
+def encode(squares, rotate180=False):
+    """
+    Returns the 8 byte led frame lighting squares (see squares_mask for the accepted types)
+    """
+    # Square names and moves come back every frame of the render loop (hints, checks), so they are cached
+    if isinstance(squares, str):
+        return _encode_string(squares, rotate180)
+    return mask_to_frame(squares_mask(squares, rotate180))
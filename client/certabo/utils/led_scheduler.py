@@ -0,0 +1,113 @@
+"""
+Decides when led frames are written to the board.
+
+Frames are sent as soon as they arrive while the serial link is idle. Under load a token bucket limits
+the rate: bursts are coalesced into the newest frame, and a pending frame is only replaced by a frame of
+the same or higher priority. A newer frame of lower priority waits until the pending one was sent (e.g.
+a move hint is shown before a misplaced piece warning that came in after it), unless it is submitted
+with replace, which drops everything pending. Frames identical to the one already shown are never sent again.
+
+Messages for usbtool can be plain 8 byte frames, (priority, frame) or (priority, frame, replace) tuples.
+"""
+import logging
+import threading
+import time
+
+from utils.logger import cfg
+
+PRIORITY_MISPLACED = 0
+PRIORITY_NORMAL = 1
+PRIORITY_HINT = 2
+
+
+def unpack(message):
+    """
+    Returns (priority, frame, replace) for a message sent to usbtool
+    """
+    if isinstance(message, tuple):
+        if len(message) == 2:
+            return message + (False,)
+        return message
+    return PRIORITY_NORMAL, message, False
+
+
+class LedScheduler:
+    def __init__(self, min_interval=.2, burst=2, clock=time.monotonic):
+        """
+        Under sustained load one frame is sent every min_interval seconds (no limit if 0),
+        after an initial burst of up to burst frames
+        """
+        self.min_interval = min_interval
+        self.burst = max(1, burst)
+        self.clock = clock
+        self.tokens = float(self.burst)
+        self.last_refill = clock()
+
+        self.last_frame = None
+        self.pending = []  # (priority, frame), oldest first, priorities decreasing
+        self.lock = threading.Lock()
+
+        self.sent = 0
+        self.coalesced = 0
+        self.deduplicated = 0
+
+    def submit(self, frame, priority=PRIORITY_NORMAL, replace=False):
+        """
+        Replaces the pending frames of the same or lower priority, or all of them if replace is set.
+        Frames of higher priority stay pending and are sent first.
+        """
+        frame = bytes(frame)
+        with self.lock:
+            if replace:
+                kept = []
+            else:
+                kept = [(pending_priority, pending) for pending_priority, pending in self.pending
+                        if pending_priority > priority]
+                if kept and cfg.DEBUG_LED:
+                    logging.debug(f'LedScheduler: {list(frame)} waits for a higher priority frame')
+            self.coalesced += len(self.pending) - len(kept)
+            self.pending = kept + [(priority, frame)]
+
+    def next_frame(self):
+        """
+        Returns the frame that should be written now, or None if there is nothing to send yet
+        """
+        with self.lock:
+            while self.pending and self.pending[0][1] == self.last_frame:
+                del self.pending[0]
+                self.deduplicated += 1
+            if not self.pending:
+                return None
+
+            if self.min_interval:
+                now = self.clock()
+                self.tokens = min(self.burst, self.tokens + (now - self.last_refill) / self.min_interval)
+                self.last_refill = now
+                if self.tokens < 1:
+                    return None
+                self.tokens -= 1
+
+            _, frame = self.pending.pop(0)
+            self.last_frame = frame
+            self.sent += 1
+            return frame
+
+    def time_until_ready(self):
+        """
+        Seconds until the next pending frame can be sent, None if nothing is pending
+        """
+        with self.lock:
+            if not self.pending:
+                return None
+            if not self.min_interval or self.tokens >= 1:
+                return 0
+            return max(0, (1 - self.tokens) * self.min_interval - (self.clock() - self.last_refill))
+
+    def reset(self):
+        """
+        Forgets the frame shown on the board (e.g., after reconnecting), so that it is sent again
+        """
+        with self.lock:
+            if not self.pending and self.last_frame is not None:
+                self.pending = [(PRIORITY_NORMAL, self.last_frame)]
+            self.last_frame = None
@@ -16,6 +16,7 @@ except ImportError:
     cfg.args = SimpleNamespace()
     cfg.args.usbport = None
     cfg.args.port_not_strict = True
+    cfg.args.record = None
 
 # set data path to current directory
 CERTABO_DATA_PATH = os.path.join(os.path.dirname(__file__), 'data')
@@ -0,0 +1,77 @@
+"""
+Finds the move played on the physical board by comparing bitboards instead of trying every legal move.
+
+The squares whose contents differ between the virtual and the physical position are found by XORing
+the piece bitboards of both. A single move always empties its from square and changes its to square
+(or the rook square when castling), so only the few legal moves between those squares need checking:
+2 changed squares for a normal move or capture, 3 for en passant and 4 for castling.
+"""
+import chess
+
+from utils.board_diff import placement, changed_mask
+
+
+def to_base_board(fen):
+    """
+    Accepts a board FEN or a full FEN, returns None if it is not valid
+    """
+    try:
+        return chess.BaseBoard(fen.split()[0])
+    except (ValueError, IndexError):
+        return None
+
+
+def infer_moves(board, physical_board, changed=None):
+    """
+    Returns every legal move of board that leads to the piece placement of physical_board
+    (usually zero or one). The result is exact: a move not touching the changed squares can not match.
+    """
+    if changed is None:
+        changed = changed_mask(board, physical_board)
+    if not changed or chess.popcount(changed) > 4:
+        return []
+
+    board = board.copy(stack=False)
+    target = placement(physical_board)
+    from_mask = changed & board.occupied_co[board.turn]
+    result = []
+    # The to_mask also covers the rook square that python-chess uses to generate castling moves
+    for move in board.generate_legal_moves(from_mask, changed):
+        board.push(move)
+        if placement(board) == target:
+            result.append(move)
+        board.pop()
+    return result
+
+
+def infer_double_moves(board, physical_board):
+    """
+    Returns every legal pair of moves (move + reply) leading to the piece placement of physical_board.
+
+    The first move empties its from square, which the reply can not refill with the same piece, so
+    only moves from the changed squares are tried. The reply is then found with infer_moves.
+    """
+    changed = changed_mask(board, physical_board)
+    if not changed:
+        return []
+
+    board = board.copy(stack=False)
+    result = []
+    for move in board.generate_legal_moves(changed & board.occupied_co[board.turn]):
+        board.push(move)
+        for move2 in infer_moves(board, physical_board):
+            result.append((move, move2))
+        board.pop()
+    return result
+
+
+def get_move_from_fens(fen1, fen2):
+    """
+    Returns the uci of the single legal move leading from fen1 (a full FEN) to the pieces of fen2,
+    or None if there is no such move
+    """
+    physical_board = to_base_board(fen2)
+    if physical_board is None:
+        return None
+    moves = infer_moves(chess.Board(fen1), physical_board)
+    return moves[0].uci() if moves else None
@@ -0,0 +1,121 @@
+"""
+Hands the moves detected on the board over to whoever plays them (GUI, lichess client, ...).
+
+Moves are buffered in order with the time they were detected, so moves made while nobody is waiting
+(premoves, fast sequences) are not lost. Consumers can block, poll or await. A full queue refuses new
+moves instead of dropping old ones, which would leave the pending moves out of sync with the board;
+move detection finds a refused move again in the next reading.
+
+A move handed out by get stays pending (see pending) until the consumer calls task_done, once it has
+played or rejected it, or asks for the next move. Move detection can then keep counting it in between.
+"""
+import asyncio
+import logging
+import queue
+import threading
+import time
+from collections import deque, namedtuple
+
+# moves is a list of uci strings, as returned by codes.get_moves
+DetectedMove = namedtuple('DetectedMove', ('moves', 'timestamp'))
+
+
+class MoveQueue:
+    def __init__(self, maxlen=16):
+        self.moves = deque(maxlen=maxlen)
+        self.in_flight = deque()  # handed out by get, not confirmed by task_done yet
+        self.condition = threading.Condition()
+        self.waiters = []  # (event loop, future) of get_async calls
+
+    def __len__(self):
+        return len(self.moves)
+
+    def put(self, moves, timestamp=None):
+        """
+        Queues a detected move, returns False if the queue is full
+        """
+        if timestamp is None:
+            timestamp = time.time()
+        with self.condition:
+            if len(self.moves) == self.moves.maxlen:
+                logging.warning(f'Move queue full, not queueing move: {moves}')
+                return False
+            self.moves.append(DetectedMove(moves, timestamp))
+            self.condition.notify()
+            # Wake up the awaiting coroutines in their own loops, the first to run takes the move
+            for loop, waiter in self.waiters:
+                try:
+                    loop.call_soon_threadsafe(_wake, waiter)
+                except RuntimeError:  # Loop closed
+                    pass
+            self.waiters.clear()
+        return True
+
+    def pop(self):
+        # Asking for a new move confirms the previous ones
+        self.in_flight.clear()
+        detected = self.moves.popleft()
+        self.in_flight.append(detected)
+        return detected
+
+    def get(self, timeout=None):
+        """
+        Returns the oldest DetectedMove, waiting up to timeout seconds (forever if None).
+        Raises queue.Empty if no move was detected in time.
+        """
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.moves, timeout):
+                raise queue.Empty
+            return self.pop()
+
+    def get_nowait(self):
+        return self.get(timeout=0)
+
+    async def get_async(self, timeout=None):
+        """
+        Awaitable version of get, raises queue.Empty on timeout. Cancelling it never consumes a move.
+        """
+        loop = asyncio.get_running_loop()
+        deadline = None if timeout is None else loop.time() + timeout
+        while True:
+            with self.condition:
+                if self.moves:
+                    return self.pop()
+                remaining = None if deadline is None else deadline - loop.time()
+                if remaining is not None and remaining <= 0:
+                    raise queue.Empty
+                waiter = loop.create_future()
+                self.waiters.append((loop, waiter))
+            try:
+                await asyncio.wait_for(waiter, remaining)
+            except asyncio.TimeoutError:
+                raise queue.Empty
+            finally:
+                with self.condition:
+                    if (loop, waiter) in self.waiters:
+                        self.waiters.remove((loop, waiter))
+
+    def task_done(self):
+        """
+        Confirms the move handed out by get, once it was played (or rejected) by the consumer
+        """
+        with self.condition:
+            if self.in_flight:
+                self.in_flight.popleft()
+
+    def pending(self):
+        """
+        Returns the moves still waiting in the queue or not confirmed yet, oldest first, without consuming them
+        """
+        with self.condition:
+            return [detected.moves for detected in self.in_flight] + [detected.moves for detected in self.moves]
+
+    def clear(self):
+        with self.condition:
+            self.moves.clear()
+            self.in_flight.clear()
+
+
+def _wake(waiter):
+    if not waiter.done():
+        waiter.set_result(None)
@@ -1,14 +1,14 @@
 import logging
 import os
-import pickle
 import queue
 import time
-from collections import Counter, deque
+from collections import Counter, deque, namedtuple
 
 import chess
 
 from utils.logger import cfg, CERTABO_DATA_PATH
-from utils import usbtool
+from utils import usbtool, frames, led_encoding, led_animation, board_diff, calibration_store
+from utils.led_scheduler import PRIORITY_NORMAL, PRIORITY_MISPLACED
 
 FEN_SPRITE_MAPPING = {"b": "black_bishop",
                       "k": "black_king",
@@ -25,10 +25,55 @@ FEN_SPRITE_MAPPING = {"b": "black_bishop",
 COLUMNS_LETTERS = "a", "b", "c", "d", "e", "f", "g", "h"
 COLUMNS_LETTERS_REVERSED = tuple(reversed(COLUMNS_LETTERS))
 
+# Emitted by BoardReader whenever the (filtered) position changes, fen is the board FEN as seen from white
+BoardChanged = namedtuple('BoardChanged', ('fen', 'changed_squares', 'timestamp'))
+
+
+def fen_to_cells(board_fen):
+    """
+    Expands a board FEN into a list of 64 pieces, starting at a8 and using '.' for empty squares
+    """
+    cells = []
+    for c in board_fen:
+        if c.isdigit():
+            cells.extend('.' * int(c))
+        elif c != '/':
+            cells.append(c)
+    return cells
+
+
+def cells_to_fen(cells):
+    """
+    Converts a list of 64 pieces, starting at a8 and using '.' for empty squares, into a board FEN
+    """
+    FEN = ''
+    for row in range(8):
+        empty = 0
+        for col in range(8):
+            piece = cells[row * 8 + col]
+            if piece == '.':
+                empty += 1
+            else:
+                if empty > 0:
+                    FEN += str(empty)
+                    empty = 0
+                FEN += piece
+        if empty > 0:
+            FEN += str(empty)
+        if row < 7:
+            FEN += r'/'
+    return FEN
+
 
 class BoardReader:
-    def __init__(self, portname):
-        self.queue = usbtool.QUEUE_FROM_USBTOOL
+    def __init__(self, portname, reading_filter=None, queue=None, data_path=CERTABO_DATA_PATH):
+        # Readings come from usbtool, unless a queue of its own is given (e.g., by utils.board_hub)
+        self.queue = usbtool.QUEUE_FROM_USBTOOL if queue is None else queue
+
+        # Optional debounce filter (see utils.reading_filter), used instead of the majority vote over data_history
+        self.reading_filter = reading_filter
+        self.last_reading = None
+        self.reading = None
 
         self.data_history_depth = 3
         self.data_history_pointer = 0
@@ -43,105 +88,215 @@ class BoardReader:
         self.board_fen = chess.Board().board_fen()
         self.counter = Counter()
 
+        # Decoded piece per cell (0 is a8, 63 is h1), patched only where the readings change
+        self.board = fen_to_cells(self.board_fen)
+        # Number of board changes so far
+        self.version = 0
+
+        # Callbacks and queues receiving a BoardChanged event for every change of the board
+        self.subscribers = []
+        self.last_change = None
+
         self.needs_calibration = False
         self.default_missing_piece = '.'
         self.ignore_missing = True
         self.code_mapping_order = ('p', 'r', 'n', 'b', 'k', 'q', 'P', 'R', 'N', 'B', 'K', 'Q')
         self.calibration_file = f'calibration-{portname.replace("/","").replace(":","")}.bin'
-        self.calibration_filepath = os.path.join(CERTABO_DATA_PATH, self.calibration_file)
+        # data_path is only changed by tools that must not touch the user's calibration (e.g., dev_tools/board_simulator)
+        self.calibration_filepath = os.path.join(data_path, self.calibration_file)
         self.code_mapping = {}
         self.load_piece_codes()
         self.cell_slice_mapping = [slice(cell * 5, cell * 5 + 5) for cell in range(64)]
 
     def load_piece_codes(self):
-        mapping = dict()
         if not os.path.exists(self.calibration_filepath):
             logging.info('No calibration file detected: creating new file')
             self.needs_calibration = True
-            pickle.dump({}, open(self.calibration_filepath, "wb"))
+            calibration_store.save(self.calibration_filepath, calibration_store.empty_calibration())
 
         logging.info(f'Loading calibration file: {self.calibration_filepath}')
-        data = pickle.load(open(self.calibration_filepath, 'rb'))
-        for letter, piece in zip(self.code_mapping_order, data):
-            for piece_variation in piece:
-                key = tuple(str(c) for c in piece_variation)
-                mapping[key] = letter
-        mapping[('0', '0', '0', '0', '0')] = '.'
+        mapping = calibration_store.load_index(self.calibration_filepath)
+        mapping[frames.EMPTY_CODE] = '.'
         self.code_mapping = mapping
 
-    def data_to_fen(self):
-        data_history = [data[1:].split(' ') for data in self.data_history if data is not None]
+    def data_to_fen(self, dirty_cells=None):
+        """
+        Recomputes the most common piece in the history for dirty_cells (all cells if None)
+        and updates the FEN if any of them changed
+        """
+        if self.reading_filter is not None:
+            # Decode the last reading again and start the filter over from it
+            if self.last_reading is not None:
+                self.reading = [self.code_mapping.get(self.last_reading[cell_range], self.default_missing_piece)
+                                for cell_range in self.cell_slice_mapping]
+                self.reading_filter.reset(self.reading)
+                self.patch_board(enumerate(self.reading))
+            return
+
+        if dirty_cells is None:
+            dirty_cells = range(64)
+        data_history = [data for data in self.data_history if data is not None]
+        if not data_history:
+            return
         # Get board pieces from USB data
-        board = []
-        for cell_range in self.cell_slice_mapping:
-            sample = (self.code_mapping.get(tuple(sample[cell_range]), self.default_missing_piece) for sample in data_history)
-            self.counter.update(sample)
-            most_common_code = self.counter.most_common(1)[0][0]
-            board.append(most_common_code)
-            self.counter.clear()
+        self.patch_board((n_cell, self.vote_cell(n_cell, data_history)) for n_cell in dirty_cells)
 
-        # Convert to FEN
-        FEN = ''
-        for row in range(8):
-            empty = 0
-            for col in range(8):
-                piece = board[row * 8 + col]
-                # if piece == 'noise':
-                #     piece = self.default_missing_piece
+    def vote_cell(self, n_cell, data_history):
+        cell_range = self.cell_slice_mapping[n_cell]
+        sample = (self.code_mapping.get(sample[cell_range], self.default_missing_piece) for sample in data_history)
+        self.counter.update(sample)
+        most_common_code = self.counter.most_common(1)[0][0]
+        self.counter.clear()
+        return most_common_code
 
-                if piece == '.':
-                    empty += 1
-                else:
-                    if empty > 0:
-                        FEN += str(empty)
-                        empty = 0
-                    FEN += piece
-            if empty > 0:
-                FEN += str(empty)
-            if row < 7:
-                FEN += r'/'
+    def filter_reading(self, data):
+        """
+        Decodes the cells that changed since the last reading and feeds them to the reading filter
+        """
+        dirty_cells = frames.diff_cells(self.last_reading, data)
+        self.last_reading = data
+        if self.reading is None:
+            self.reading = [self.default_missing_piece] * 64
+        for n_cell in dirty_cells:
+            self.reading[n_cell] = self.code_mapping.get(data[self.cell_slice_mapping[n_cell]], self.default_missing_piece)
+
+        accepted_cells = self.reading_filter.update(self.reading, dirty_cells)
+        if accepted_cells:
+            accepted = self.reading_filter.accepted
+            self.patch_board((n_cell, accepted[n_cell]) for n_cell in accepted_cells)
+
+    def patch_board(self, pieces):
+        """
+        Sets the given (cell, piece) pairs on the board and updates the FEN if any of them changed
+        """
+        board = self.board
+        changed_mask = 0
+        for n_cell, piece in pieces:
+            if board[n_cell] != piece:
+                board[n_cell] = piece
+                changed_mask |= chess.BB_SQUARES[n_cell ^ 56]  # cell -> chess square
+
+        if not changed_mask:
+            if cfg.DEBUG_READING:
+                logging.debug('UsbReader: computing FEN -> board not changed')
+            return
+
+        # Convert to FEN
+        FEN = cells_to_fen(board)
 
         if cfg.DEBUG_READING:
-            if self.board_fen != FEN:
-                new_update_time = time.time()
-                diff_update_time = (new_update_time - self.last_update_time) * 1000
-                logging.debug(f'UsbReader: computing FEN -> board CHANGED - {FEN} in {diff_update_time:.0f}ms')
-                self.last_update_time = new_update_time
-            else:
-                logging.debug('UsbReader: computing FEN -> board not changed')
+            new_update_time = time.time()
+            diff_update_time = (new_update_time - self.last_update_time) * 1000
+            logging.debug(f'UsbReader: computing FEN -> board CHANGED - {FEN} in {diff_update_time:.0f}ms')
+            self.last_update_time = new_update_time
         self.board_fen = FEN
+        self.version += 1
+        self.emit(BoardChanged(FEN, chess.SquareSet(changed_mask), time.time()))
+
+    def subscribe(self, subscriber=None, maxsize=0):
+        """
+        Registers a callback, called with a BoardChanged event from the thread that updates the reader.
+        Without a callback a queue.Queue is registered and returned instead, so that another thread can
+        block on it. Events are dropped for a full queue.
+        """
+        if subscriber is None:
+            subscriber = queue.Queue(maxsize)
+        self.subscribers.append(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        try:
+            self.subscribers.remove(subscriber)
+        except ValueError:
+            pass
+
+    def emit(self, event):
+        self.last_change = event
+        for subscriber in self.subscribers:
+            if isinstance(subscriber, queue.Queue):
+                try:
+                    subscriber.put_nowait(event)
+                except queue.Full:
+                    logging.debug('UsbReader: subscriber queue full, dropping board change')
+            else:
+                try:
+                    subscriber(event)
+                except Exception:
+                    logging.exception('UsbReader: board change subscriber failed')
 
-    def update(self):
+    def wait_for_change(self, timeout=None):
+        """
+        Blocks on the readings from usbtool until one of them changes the board.
+        Returns the BoardChanged event, or None if nothing changed within timeout seconds.
+        """
+        version = self.version
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self.version == version:
+            remaining = None
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+            try:
+                data = self.queue.get(timeout=remaining)
+            except queue.Empty:
+                return None
+            self.update(data)
+        return self.last_change
+
+    def add_reading(self, data):
+        """
+        Adds a reading to the history (and reading filter), returns the cells that changed in the history
+        or None if the reading is not valid
+        """
+        # Bluetooth readings arrive as text
+        if not isinstance(data, bytes):
+            data = frames.parse_frame(data)
+            if data is None:
+                return None
+        if self.reading_filter is not None:
+            self.filter_reading(data)
+
+        # Check if data stream is different than any other saved in the history
+        for _ in range(self.data_history_depth):
+
+            self.data_history_pointer += 1
+            if self.data_history_pointer >= self.data_history_depth:
+                self.data_history_pointer = 0
+
+            old_data = self.data_history[self.data_history_pointer]
+            if not old_data == data:
+                # If it is replace it,
+                # and break out of loop to avoid rewriting more than one entry in the history
+                self.data_history[self.data_history_pointer] = data
+                return frames.diff_cells(old_data, data)
+        return set()
+
+    def update(self, data=None):
+        """
+        Processes data (if given) and every reading waiting in the queue
+        """
         # TODO: Add timer and log when board cannot be read for too long
-        changed = False
+        dirty_cells = set()
         new_data = False
         while True:
-            try:
-                data = self.queue.get_nowait()
+            if data is None:
+                try:
+                    data = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+            changed_cells = self.add_reading(data)
+            data = None
+            if changed_cells is not None:
                 new_data = True
+                dirty_cells |= changed_cells
 
-                # Check if data stream is different than any other saved in the history
-                for _ in range(self.data_history_depth):
-
-                    self.data_history_pointer += 1
-                    if self.data_history_pointer >= self.data_history_depth:
-                        self.data_history_pointer = 0
-
-                    if not self.data_history[self.data_history_pointer] == data:
-                        # If it is replace it,
-                        # and break out of loop to avoid rewriting more than one entry in the history
-                        self.data_history[self.data_history_pointer] = data
-                        changed = True
-                        break
-
-            except queue.Empty:
-                if new_data:
-                    # This is used for calibration, to know when a new sample was obtained
-                    self.data_history_counter = (self.data_history_counter + 1) % 64  # Limit number range to 64 values
+        if new_data:
+            # This is used for calibration, to know when a new sample was obtained
+            self.data_history_counter = (self.data_history_counter + 1) % 64  # Limit number range to 64 values
 
-                if changed:
-                    self.data_to_fen()
-                return
+        if dirty_cells and self.reading_filter is None:
+            self.data_to_fen(dirty_cells)
 
     def read_board(self, rotate180=False, update=True):
         if update:
@@ -153,7 +308,7 @@ class BoardReader:
 
     def do_calibration(self, new_setup, verbose=False):
         # STEP 1) Combine data and find most common codes per cell
-        data_history = [data[1:].split(' ') for data in self.calibration_samples if data is not None]
+        data_history = [data for data in self.calibration_samples if data is not None]
 
         board_reading = []
         for n_cell, cell_range in enumerate(self.cell_slice_mapping):
@@ -164,9 +319,9 @@ class BoardReader:
                 logging.info(f"\n    {cell_id} samples:")
 
             for sample in data_history:
-                cell_readings.append(tuple(sample[cell_range]))
+                cell_readings.append(sample[cell_range])
                 if verbose:
-                    logging.info(sample[cell_range])
+                    logging.info(list(sample[cell_range]))
 
             self.counter.update(cell_readings)
             most_common = self.counter.most_common(1)[0][0]
@@ -174,9 +329,7 @@ class BoardReader:
 
             board_reading.extend(most_common)
             if verbose:
-                logging.info(f"\n   Final code for {cell_id}: {most_common}")
-
-        board_reading = [int(val) for val in board_reading]
+                logging.info(f"\n   Final code for {cell_id}: {list(most_common)}")
 
         # --------------------------------------------------------------------------------------------------------------
         # STEP 2) Save codes obtained from board_reading
@@ -205,7 +358,7 @@ class BoardReader:
                 # Skip empty square
                 if piece == '.':
                     continue
-                code_int_list = [int(num) for num in code]
+                code_int_list = list(code)
                 calibration_mapping[piece].append(code_int_list)
 
         for i in range(8):
@@ -235,8 +388,7 @@ class BoardReader:
         add_mapping('k', 4)
         add_mapping('K', 60)
 
-        calibration_data = [calibration_mapping[key] for key in self.code_mapping_order]
-        pickle.dump(calibration_data, open(self.calibration_filepath, "wb"))
+        calibration_store.save(self.calibration_filepath, calibration_mapping)
 
         if new_setup:
             logging.info(f'Calibration: New mapping obtained:')
@@ -276,117 +428,121 @@ class BoardReader:
         if default_missing_piece != self.default_missing_piece:
             logging.info(f'Ignore missing: {value}')
             self.default_missing_piece = default_missing_piece
+            # Unknown cells are decoded differently now
+            self.data_to_fen()
 
 
 class LedWriter:
     def __init__(self):
         self.queue_to_usbtool = usbtool.QUEUE_TO_USBTOOL
+        # Pre-built frames
         self.default_messages = {
-            'all': [255] * 8,
-            'none': [0] * 8,
-            'start': [255, 255, 0, 0, 0, 0, 255, 255],
-            'error': [0, 0, 0, 24, 24, 0, 0, 0],
+            'all': bytes([255] * 8),
+            'none': led_encoding.EMPTY_FRAME,
+            'start': bytes([255, 255, 0, 0, 0, 0, 255, 255]),
+            'error': bytes([0, 0, 0, 24, 24, 0, 0, 0]),
             'corners': LedWriter.squares2led(['a1', 'a8', 'h1', 'h8']),
             'corner': LedWriter.squares2led(['a8']),
             'center': LedWriter.squares2led(['d4', 'e4', 'd5', 'e5']),
             'thinking': LedWriter.squares2led(['d4', 'e4', 'd5', 'e5']),
-            'setup': [255, 255, 8, 0, 0, 8, 255, 255],
+            'setup': bytes([255, 255, 8, 0, 0, 8, 255, 255]),
         }
 
         self.last_message = None
 
-        self.last_flash_message = None
+        # Flashing and pulsing leds are played by a background thread, see utils.led_animation
+        self.animator = led_animation.LedAnimator(self.send_frame)
+        self.last_animation = None
         self.flash_frequency = 1  # seconds
-        self.flash_clock = None
-        self.counter = 0
 
         self.last_misplaced_comparison = None
         self.last_misplaced_message = None
         self.misplaced_wait_time = 3  # seconds
         self.misplaced_clock = None
 
-    def flash_leds(self, message, rotate180=False):
-        # New message
-        if self.last_flash_message != message:
-            self.last_flash_message = message
-            self.flash_clock = time.time()
-            self.counter = 0
-            if cfg.DEBUG_LED:
-                logging.debug(f'LedManager: New flash - {message}')
-            self.set_leds(message)
+    def flash_leds(self, message, rotate180=False, priority=PRIORITY_NORMAL):
+        """
+        Flashes a message on and off every flash_frequency seconds until other leds are set.
+        Can be called on every frame, the animation only restarts when the message changes.
+        """
+        self.animate('flash', message, rotate180, priority)
+
+    def pulse_leds(self, message, rotate180=False, priority=PRIORITY_NORMAL):
+        """
+        Blinks a message twice in a row, repeatedly (e.g., for a king in check)
+        """
+        self.animate('pulse', message, rotate180, priority)
+
+    def game_over_leds(self, message='all', rotate180=False):
+        self.animate('game_over', message, rotate180)
+
+    def animate(self, pattern, message, rotate180=False, priority=PRIORITY_NORMAL):
+        key = (pattern, message, rotate180)
+        if key == self.last_animation:
             return
+        self.last_animation = key
+        # Leds shown by the animation are not tracked, whatever is set next must be sent
+        self.last_message = None
+
+        frame = self.message_to_frame(message, rotate180)
+        if pattern == 'flash':
+            animation = led_animation.flash(frame, self.flash_frequency)
+        elif pattern == 'pulse':
+            animation = led_animation.pulse(frame)
+        else:
+            animation = led_animation.game_over(frame, rotate180)
 
-        # Flash message on/off every 1 second
-        elapsed_time = time.time()
-        if elapsed_time - self.flash_clock > self.flash_frequency:
-            self.flash_clock = elapsed_time
-            self.counter += 1
-            message = (self.last_flash_message, 'none')[self.counter % 2]
+        if cfg.DEBUG_LED:
+            logging.debug(f'LedManager: New {pattern} - {message}')
+        self.animator.play(animation, priority)
+
+    def message_to_frame(self, message, rotate180=False):
+        # If text is given try to retrieve default message, otherwise assume square information was passed
+        try:
+            return self.default_messages[message]
+        except (KeyError, TypeError) as e:
+            return self.squares2led(message, rotate180)
+
+    def send_frame(self, frame, priority=PRIORITY_NORMAL, replace=False):
+        self.queue_to_usbtool.put((priority, frame, replace))
+
+    def set_leds(self, message='none', rotate180=False, priority=PRIORITY_NORMAL, replace=False):
+        """
+        Sends a default message (e.g., 'all') or squares to the board and stops any running animation.
+        Under load usbtool lets frames with higher priority (see utils.led_scheduler) go first. A running
+        animation of higher priority (e.g., a hint) is left alone, unless replace is set, which also drops
+        the frames still pending in usbtool.
+        """
+        if not replace and self.animator.running and self.animator.priority > priority:
             if cfg.DEBUG_LED:
-                logging.debug(f'LedManager: repeated flash - {self.last_flash_message} -> {message}')
-            self.set_leds(message, rotate180)
+                logging.debug(f'LedManager: ignoring {message}, higher priority animation running')
+            return
+
+        if self.last_animation is not None:
+            self.animator.stop()
+            self.last_animation = None
 
-    def set_leds(self, message='none', rotate180=False):
         if message != self.last_message:
             self.last_message = message
-            # If text is given try to retrieve default message, otherwise assume square information was passed
-            try:
-                message = self.default_messages[message]
-            except (KeyError, TypeError) as e:
-                message = self.squares2led(message, rotate180)
+            message = self.message_to_frame(message, rotate180)
 
-            # message = [ord(d) for d in message]
             if cfg.DEBUG_LED:
                 logging.debug(f'LedManager: got message - {self.last_message}')
                 logging.debug(f'LedManager: sending to usbtool - {message}, {len(message)}')
 
-            self.queue_to_usbtool.put(bytes(message))
+            self.send_frame(message, priority, replace)
             time.sleep(.001)
 
     @staticmethod
     def squares2led(squares, rotate180=False):
         """
         Converts list of squares to Certabo binary led encoding
-        e.g., ['e2', 'e4'] = [0, 0, 0, 0, 16, 0, 16, 0] -> '\x00\x00\x00\x00\x10\x00\x10\x00'
+        e.g., ['e2', 'e4'] -> b'\x00\x00\x00\x00\x10\x00\x10\x00' (see utils.led_encoding)
 
-        Accepts alternative string input (eg., 'e2' or even move string 'e2e4')
+        Accepts alternative string input (eg., 'e2' or even move string 'e2e4'), chess.Move and chess.SquareSet
         Does not recognize move string inside list (e.g., ['e2e4'])
         """
-
-        def _square2certabo(square, rotate180=False):
-            """
-            Converts a chess position code (e.g., e2) to the respective Certabo led code (e.g., led[6] = 16)
-            """
-            if rotate180:
-                col = COLUMNS_LETTERS_REVERSED.index(square[0])
-                row = 9 - int(square[1])
-            else:
-                col = COLUMNS_LETTERS.index(square[0])
-                row = int(square[1])
-
-            return 8 - row, 2 ** col
-
-        # If single string was given assume a single square or move was passed
-        if type(squares) == str:
-            # Assume single square and force tuple
-            if len(squares) < 4:
-                led_positions = (_square2certabo(squares, rotate180),)
-            # Assume move
-            else:
-                led_positions = (_square2certabo(squares[i: i+2], rotate180) for i in (0, 2))
-        # Otherwise assume a list of squares was given
-        else:
-            # If list contains only one item, force tuple
-            if len(squares) == 1:
-                led_positions = (_square2certabo(squares[0], rotate180), )
-            else:
-                led_positions = (_square2certabo(square, rotate180) for square in set(squares))
-
-        leds = [0] * 8
-        for row, col in led_positions:
-            leds[row] += col
-
-        return leds
+        return led_encoding.encode(squares, rotate180)
 
     def highlight_misplaced_pieces(self, physical_board_fen, virtual_board, rotate180=False, suppress_leds=False):
         """
@@ -400,22 +556,20 @@ class LedWriter:
         if boards_fens == self.last_misplaced_comparison:
             if time.time() - self.misplaced_clock > self.misplaced_wait_time:
                 if not suppress_leds:
-                    self.set_leds(self.last_misplaced_message, rotate180)
+                    self.set_leds(self.last_misplaced_message, rotate180, PRIORITY_MISPLACED)
                 return True
 
         # Otherwise find which leds should be highlighted
         else:
             try:
-                temp_board = chess.Board()
-                temp_board.set_board_fen(physical_board_fen)
+                misplaced_mask = board_diff.diff_fens(physical_board_fen, virtual_board.board_fen())
             except ValueError:
                 logging.error('Corrupt FEN from physical board')
             else:  # No Exception
-                diffs = [chess.SQUARE_NAMES[square] for square in range(64) if
-                         virtual_board.piece_at(square) != temp_board.piece_at(square)]
-                if diffs:
+                if misplaced_mask:
+                    diffs = chess.SquareSet(misplaced_mask)
                     if cfg.DEBUG_LED:
-                        logging.debug(f'LedManager: found new board differences: {diffs}')
+                        logging.debug(f'LedManager: found new board differences: {[chess.SQUARE_NAMES[square] for square in diffs]}')
                         logging.debug(f'LedManager: waiting {self.misplaced_wait_time} seconds to highlight them')
                     self.last_misplaced_comparison = boards_fens
                     self.last_misplaced_message = diffs
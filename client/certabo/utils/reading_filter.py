@@ -0,0 +1,124 @@
+"""
+Debounce filters for the pieces read from the board.
+
+A filter receives the pieces decoded from every new reading, one per cell (0 is a8, 63 is h1), and
+decides when a cell is stable enough for its piece to be accepted. Each cell is accepted on its own,
+so a move is reported as soon as the two squares involved settle.
+
+The default majority vote over the last readings lives in BoardReader itself, these filters are an
+alternative with a tunable latency / stability trade-off:
+
+    ConsecutiveFilter: accepts a piece after N identical consecutive readings (low latency)
+    ConfidenceFilter: accepts a piece when its exponentially averaged share of readings reaches a threshold
+        (a single noisy reading does not reset a stable cell)
+"""
+import logging
+
+
+class ConsecutiveFilter:
+    def __init__(self, reads=2):
+        self.reads = max(1, int(reads))
+        self.accepted = None
+        self.candidates = {}  # cell -> [piece, count] for cells whose reading differs from the accepted piece
+
+    def reset(self, cells):
+        self.accepted = list(cells)
+        self.candidates.clear()
+
+    def update(self, cells, dirty_cells):
+        """
+        Feeds the pieces of a new reading, where dirty_cells are the cells that changed since the previous one.
+        Returns the cells whose accepted piece changed.
+        """
+        if self.accepted is None:
+            self.reset(cells)
+            return set(range(64))
+
+        changed = set()
+        for n_cell in dirty_cells | self.candidates.keys():
+            piece = cells[n_cell]
+            if piece == self.accepted[n_cell]:
+                self.candidates.pop(n_cell, None)
+                continue
+
+            candidate = self.candidates.get(n_cell)
+            if candidate is None or candidate[0] != piece:
+                candidate = self.candidates[n_cell] = [piece, 0]
+            candidate[1] += 1
+            if candidate[1] >= self.reads:
+                self.accepted[n_cell] = piece
+                del self.candidates[n_cell]
+                changed.add(n_cell)
+        return changed
+
+
+class ConfidenceFilter:
+    def __init__(self, alpha=.5, threshold=.7):
+        self.alpha = alpha
+        self.threshold = threshold
+        self.accepted = None
+        self.scores = {}  # cell -> {piece: score} for cells that are not settled
+
+    def reset(self, cells):
+        self.accepted = list(cells)
+        self.scores.clear()
+
+    def update(self, cells, dirty_cells):
+        """
+        Feeds the pieces of a new reading, where dirty_cells are the cells that changed since the previous one.
+        Returns the cells whose accepted piece changed.
+        """
+        if self.accepted is None:
+            self.reset(cells)
+            return set(range(64))
+
+        changed = set()
+        for n_cell in dirty_cells | self.scores.keys():
+            piece = cells[n_cell]
+            scores = self.scores.get(n_cell)
+            if scores is None:
+                if piece == self.accepted[n_cell]:
+                    continue
+                # Settled cells start with full confidence in their accepted piece
+                scores = self.scores[n_cell] = {self.accepted[n_cell]: 1.}
+
+            for key in scores:
+                scores[key] *= 1 - self.alpha
+            scores[piece] = scores.get(piece, 0) + self.alpha
+
+            if scores[piece] >= self.threshold:
+                if piece != self.accepted[n_cell]:
+                    self.accepted[n_cell] = piece
+                    changed.add(n_cell)
+                # Cell is settled again
+                del self.scores[n_cell]
+        return changed
+
+
+FILTERS = {
+    'consecutive': ConsecutiveFilter,
+    'confidence': ConfidenceFilter,
+}
+
+
+def create_reading_filter(settings):
+    """
+    Creates a filter from board settings, e.g. 'consecutive' or {'type': 'confidence', 'alpha': .4}.
+    Returns None for the default majority vote.
+    """
+    if not settings or settings == 'majority':
+        return None
+    if isinstance(settings, str):
+        settings = {'type': settings}
+
+    options = dict(settings)
+    name = options.pop('type', 'majority')
+    if name == 'majority':
+        return None
+    try:
+        reading_filter = FILTERS[name](**options)
+    except (KeyError, TypeError) as e:
+        logging.warning(f'Invalid reading filter settings {settings}: {e}, using majority vote')
+        return None
+    logging.info(f'Using reading filter: {settings}')
+    return reading_filter
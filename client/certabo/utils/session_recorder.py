@@ -0,0 +1,270 @@
+"""
+Records what a board sends (and the leds written to it) to a compact append-only log, and plays it back.
+
+Consecutive readings are almost always identical, so each frame is stored as a difference to the
+previous one, and its time as the milliseconds since the previous record: a repeated frame costs 2 bytes,
+a move ~20 bytes, and an hour of play at 10 readings per second stays well under 100kB.
+Layout, integers big endian, varints are LEB128:
+
+    file:     b'CRTS', version (1 byte), then records
+    record:   kind (1 byte), then
+        SESSION:  start time (8 byte float, seconds since the epoch)
+        SAME:     time (varint, ms)
+        FULL:     time (varint, ms), frame (320 bytes)
+        DELTA:    time (varint, ms), mask of changed cells (8 bytes, bit n is cell n), 5 bytes per changed cell
+        LEDS:     time (varint, ms), led frame (8 bytes)
+        INVALID:  time (varint, ms), length (varint), raw line as received
+
+Times are relative to the previous record of the session (to the session start in version 1 files).
+
+Recording is enabled with --record [path], and a log is replayed into the reading pipeline with:
+
+    session_recorder.replay(path, board_reader.update, speed=4)
+"""
+import atexit
+import logging
+import os
+import struct
+import threading
+import time
+from collections import namedtuple
+
+from utils.logger import cfg, CERTABO_DATA_PATH
+from utils import frames
+
+MAGIC = b'CRTS'
+VERSION = 2
+SESSION, SAME, FULL, DELTA, LEDS, INVALID = range(6)
+KIND_NAMES = {SAME: 'frame', FULL: 'frame', DELTA: 'frame', LEDS: 'leds', INVALID: 'invalid'}
+
+START_TIME = struct.Struct('>d')
+MASK = struct.Struct('>Q')
+LED_FRAME_LENGTH = 8
+MAX_INVALID_LENGTH = 4096
+
+# kind is 'frame', 'leds' or 'invalid', timestamp is in seconds since the epoch
+Record = namedtuple('Record', ('timestamp', 'kind', 'data'))
+
+
+def encode_varint(value):
+    data = bytearray()
+    while value > 0x7f:
+        data.append(value & 0x7f | 0x80)
+        value >>= 7
+    data.append(value)
+    return bytes(data)
+
+
+def decode_varint(data, offset):
+    """
+    Returns (value, new offset), raises IndexError if data ends within the varint
+    """
+    value = shift = 0
+    while True:
+        byte = data[offset]
+        offset += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value, offset
+        shift += 7
+
+
+class SessionRecorder:
+    def __init__(self, path, flush_interval=1.):
+        """
+        Appends a new session to path (created if needed). Data is flushed at most flush_interval
+        seconds after being recorded, and when the recorder is closed.
+        """
+        self.path = path
+        self.flush_interval = flush_interval
+        self.lock = threading.Lock()
+        new_file = not os.path.exists(path) or os.path.getsize(path) == 0
+        if not new_file:
+            with open(path, 'rb') as f:
+                header = f.read(len(MAGIC) + 1)
+            if header != MAGIC + bytes([VERSION]):
+                raise OSError(f'{path} is not a version {VERSION} board session file')
+        self.file = open(path, 'ab')
+        if new_file:
+            self.file.write(MAGIC + bytes([VERSION]))
+        self.start = time.time()
+        self.file.write(bytes([SESSION]) + START_TIME.pack(self.start))
+        self.last_ms = 0  # time of the previous record, ms since start
+        self.last_frame = None
+        self.last_flush = time.monotonic()
+        self.bytes_written = 0
+        atexit.register(self.close)
+        logging.info(f'Recording board session to {path}')
+
+    def write(self, kind, payload=b''):
+        elapsed_ms = max(self.last_ms, int((time.time() - self.start) * 1000))
+        record = bytes([kind]) + encode_varint(elapsed_ms - self.last_ms) + payload
+        self.last_ms = elapsed_ms
+        self.file.write(record)
+        self.bytes_written += len(record)
+        now = time.monotonic()
+        if now - self.last_flush >= self.flush_interval:
+            self.file.flush()
+            self.last_flush = now
+
+    def add_frame(self, frame):
+        with self.lock:
+            if self.file is None:
+                return
+            if frame == self.last_frame:
+                self.write(SAME)
+            else:
+                cells = sorted(frames.diff_cells(self.last_frame, frame))
+                if len(cells) * frames.CODE_LENGTH + MASK.size < frames.FRAME_LENGTH:
+                    mask = 0
+                    for n_cell in cells:
+                        mask |= 1 << n_cell
+                    self.write(DELTA, MASK.pack(mask) + b''.join(frames.cell_code(frame, n_cell) for n_cell in cells))
+                else:
+                    self.write(FULL, bytes(frame))
+                self.last_frame = frame
+
+    def add_line(self, line):
+        """
+        Records a raw line read from the board, as a frame or, if it does not parse, as an invalid line
+        """
+        frame = frames.parse_frame(line)
+        if frame is not None:
+            self.add_frame(frame)
+        else:
+            self.add_invalid(line)
+
+    def add_invalid(self, line):
+        if isinstance(line, str):
+            line = line.encode('ascii', 'replace')
+        line = bytes(line[:MAX_INVALID_LENGTH])
+        with self.lock:
+            if self.file is not None:
+                self.write(INVALID, encode_varint(len(line)) + line)
+
+    def add_leds(self, led_frame):
+        with self.lock:
+            if self.file is not None and len(led_frame) == LED_FRAME_LENGTH:
+                self.write(LEDS, bytes(led_frame))
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+                logging.info(f'Recorded {self.bytes_written} bytes of board session to {self.path}')
+
+
+def open_recorder(name):
+    """
+    Returns a SessionRecorder if recording was requested with --record, None otherwise.
+    Without an explicit path the session is recorded in the data folder, named after name (e.g., the port).
+    """
+    path = getattr(cfg.args, 'record', None)
+    if not path:
+        return None
+    if path == 'auto':
+        name = str(name or 'board').replace('/', '').replace(':', '').replace('\\', '')
+        path = os.path.join(CERTABO_DATA_PATH, f'session-{name}-{time.strftime("%Y%m%d-%H%M%S")}.crs')
+    try:
+        return SessionRecorder(path)
+    except OSError as e:
+        logging.warning(f'Cannot record board session to {path}: {e}')
+        return None
+
+
+def is_session_file(path):
+    with open(path, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def read_session(path):
+    """
+    Yields the Records of every session in the file, in order. A record cut short (e.g., by a crash
+    while recording) ends the iteration.
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+    if not data.startswith(MAGIC):
+        raise ValueError(f'{path} is not a board session file')
+    version = data[len(MAGIC)]
+    if version > VERSION:
+        raise ValueError(f'Session format version {version} is not supported')
+
+    offset = len(MAGIC) + 1
+    start = 0.
+    elapsed_ms = 0
+    frame = None
+    try:
+        while offset < len(data):
+            kind = data[offset]
+            offset += 1
+            if kind == SESSION:
+                start, = START_TIME.unpack_from(data, offset)
+                offset += START_TIME.size
+                elapsed_ms = 0
+                frame = None
+                continue
+
+            record_ms, offset = decode_varint(data, offset)
+            elapsed_ms = elapsed_ms + record_ms if version >= 2 else record_ms
+            timestamp = start + elapsed_ms / 1000
+            if kind == SAME:
+                if frame is None:
+                    raise ValueError('Repeated frame before any frame')
+                payload = frame
+            elif kind == FULL:
+                payload = frame = data[offset: offset + frames.FRAME_LENGTH]
+                offset += frames.FRAME_LENGTH
+            elif kind == DELTA:
+                if frame is None:
+                    raise ValueError('Frame difference before any frame')
+                mask, = MASK.unpack_from(data, offset)
+                offset += MASK.size
+                new_frame = bytearray(frame)
+                while mask:
+                    n_cell = (mask & -mask).bit_length() - 1
+                    start_byte = n_cell * frames.CODE_LENGTH
+                    new_frame[start_byte: start_byte + frames.CODE_LENGTH] = data[offset: offset + frames.CODE_LENGTH]
+                    offset += frames.CODE_LENGTH
+                    mask &= mask - 1
+                payload = frame = bytes(new_frame)
+            elif kind == LEDS:
+                payload = data[offset: offset + LED_FRAME_LENGTH]
+                offset += LED_FRAME_LENGTH
+            elif kind == INVALID:
+                length, offset = decode_varint(data, offset)
+                payload = data[offset: offset + length]
+                offset += length
+            else:
+                raise ValueError(f'Unknown record kind {kind}')
+
+            if offset > len(data):
+                return
+            yield Record(timestamp, KIND_NAMES[kind], payload)
+    except (IndexError, struct.error):
+        return
+
+
+def replay(path, handler, speed=1., kinds=('frame',), max_gap=5.):
+    """
+    Calls handler(data) for the records of the given kinds, waiting between them as during the recording
+    divided by speed (speed 0 does not wait at all). Pauses longer than max_gap seconds, e.g. between two
+    sessions, are shortened. Feeding frames to BoardReader.update (or to the usbtool queue) reproduces
+    what the board sent. Returns the number of records handled.
+    """
+    n = 0
+    last_timestamp = None
+    next_time = time.monotonic()
+    for record in read_session(path):
+        if record.kind not in kinds:
+            continue
+        if speed and last_timestamp is not None:
+            next_time += min(max(0., record.timestamp - last_timestamp), max_gap) / speed
+            wait = next_time - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+        last_timestamp = record.timestamp
+        handler(record.data)
+        n += 1
+    return n
@@ -3,35 +3,36 @@ import multiprocessing
 import queue
 import threading
 import time
-from collections import deque
 import serial
 from serial.tools.list_ports import comports
 
 from utils.logger import cfg
+from utils import frames, led_scheduler, session_recorder
 
 QUEUE_TO_USBTOOL = queue.Queue(maxsize=64)
 QUEUE_FROM_USBTOOL = queue.Queue(maxsize=64)
 
+# How long a serial read may block waiting for board data. It also bounds the delay before
+# a rate limited led message is sent, as both happen in the same loop.
+READ_TIMEOUT = .05
 
-def _usbtool(address_chessboard, queue_to_usbtool, queue_from_usbtool, buffer_ms=750):
+
+def _usbtool(address_chessboard, queue_to_usbtool, queue_from_usbtool, buffer_ms=200):
     logging.info("--- Starting Usbtool ---")
-    logging.info(f'Usbtool buffer = {buffer_ms}ms')
+    logging.info(f'Usbtool led interval under load = {buffer_ms}ms')
 
     socket = None
     socket_ok = False
     first_connection = True
 
-    time_last_message_to_board = 0
-    buffer = buffer_ms / 1000
-    message_to_board = deque(maxlen=1)
+    scheduler = led_scheduler.LedScheduler(min_interval=buffer_ms / 1000)
 
-    message_from_board = ""
+    frame_buffer = frames.FrameBuffer()
     last_reading_time = time.time()
+    recorder = None  # opened once the port is known, on the first connection
 
     try:
         while True:
-            time.sleep(.001)
-
             # Try to (re)connect to board
             if not socket_ok:
                 try:
@@ -42,7 +43,9 @@ def _usbtool(address_chessboard, queue_to_usbtool, queue_from_usbtool, buffer_ms
                             time.sleep(.5)
                             continue
 
-                    socket = serial.Serial(address_chessboard, 38400, timeout=2.5)
+                    socket = serial.Serial(address_chessboard, 38400, timeout=READ_TIMEOUT)
+                    frame_buffer.clear()
+                    scheduler.reset()
 
                 except Exception as e:
                     logging.warning(f'Failed to (re)connect to port {address_chessboard}: {e}')
@@ -53,49 +56,56 @@ def _usbtool(address_chessboard, queue_to_usbtool, queue_from_usbtool, buffer_ms
                     socket_ok = True
                     if first_connection:
                         first_connection = False
+                    if recorder is None:
+                        recorder = session_recorder.open_recorder(address_chessboard)
 
-            # Store message to board
-            try:
-                new_message = queue_to_usbtool.get_nowait()
-                message_to_board.append(new_message)
-            except queue.Empty:
-                pass
+            # Collect messages to board, the scheduler keeps only what still needs to be sent
+            while True:
+                try:
+                    priority, message, replace = led_scheduler.unpack(queue_to_usbtool.get_nowait())
+                except queue.Empty:
+                    break
+                scheduler.submit(message, priority, replace)
 
             # Send message to board
-            if len(message_to_board) and time.time() >= time_last_message_to_board + buffer:
-                data = message_to_board.pop()
+            data = scheduler.next_frame()
+            if data is not None:
                 try:
                     socket.reset_output_buffer()
                     socket.write(data)
+                    if recorder is not None:
+                        recorder.add_leds(data)
                 except Exception as e:
                     logging.warning(f'Could not write to serial port {e}')
                     socket_ok = False
                     continue
                 else:  # No Exception
-                    time_last_message_to_board = time.time()
                     if cfg.DEBUG_LED:
                         logging.debug(f'Usbtool: sending to board - {list(data)}')
 
-            # Read messages from board
+            # Read messages from board: take whatever is waiting in one go,
+            # or block until data arrives (or the timeout expires) when nothing is
             try:
-                while socket.inWaiting():
-                    c = socket.read().decode('ISO-8859-1')
-
-                    # Look for newline
-                    if not c == '\n':
-                        message_from_board += c
-                    else:
-                        message_from_board = message_from_board[:-2]  # Remove trailing ' /r'
-                        if len(message_from_board.split(" ")) == 320:  # 64*5
-                            queue_from_usbtool.put(message_from_board)
-
-                        message_from_board = ''
-                        socket.reset_input_buffer()
-                        if cfg.DEBUG_READING:
-                            new_reading_time = time.time()
-                            diff_reading_time = (new_reading_time - last_reading_time)*1000
-                            logging.debug(f'Usbtool: got reading in {diff_reading_time:.0f}ms')
-                            last_reading_time = new_reading_time
+                data = socket.read(max(1, socket.in_waiting))
+                if data:
+                    frame_buffer.feed(data)
+                    # Only the newest complete reading matters, older ones in the same chunk are stale.
+                    # Any partial reading stays in the buffer, so the stream never needs to be flushed.
+                    lines = frame_buffer.pop_lines()
+                    if recorder is not None:
+                        for line in lines:
+                            recorder.add_line(line)
+                    for line in reversed(lines):
+                        frame = frames.parse_frame(line)
+                        if frame is not None:
+                            _put_latest(queue_from_usbtool, frame)
+                            break
+
+                    if lines and cfg.DEBUG_READING:
+                        new_reading_time = time.time()
+                        diff_reading_time = (new_reading_time - last_reading_time)*1000
+                        logging.debug(f'Usbtool: got reading in {diff_reading_time:.0f}ms ({len(lines) - 1} stale readings skipped)')
+                        last_reading_time = new_reading_time
 
             except Exception as e:
                 logging.warning(f'Could not read from serial port: {e}')
@@ -108,9 +118,26 @@ def _usbtool(address_chessboard, queue_to_usbtool, queue_from_usbtool, buffer_ms
             time.sleep(1)
             socket.write(bytes([0, 0, 0, 0, 0, 0, 0, 0]))
             socket.close()
+        if recorder is not None:
+            recorder.close()
+
+
+def _put_latest(queue_from_usbtool, frame):
+    """
+    Puts a new reading in the queue, discarding the oldest one if the consumer fell behind
+    """
+    while True:
+        try:
+            queue_from_usbtool.put_nowait(frame)
+            return
+        except queue.Full:
+            try:
+                queue_from_usbtool.get_nowait()
+            except queue.Empty:
+                pass
 
 
-def start_usbtool(address_chessboard, buffer_ms=750, separate_process=False):
+def start_usbtool(address_chessboard, buffer_ms=200, separate_process=False):
 
     global QUEUE_TO_USBTOOL
     global QUEUE_FROM_USBTOOL
@@ -134,6 +161,24 @@ def start_usbtool(address_chessboard, buffer_ms=750, separate_process=False):
         return thread
 
 
+def find_addresses():
+    """
+    Returns every available port with the Certabo driver ('cp210x' in its description), for hosts with several boards
+    """
+    addresses = []
+    for port in comports():
+        device, description = port[0], port[1]
+        if 'cp210' not in description.lower():
+            continue
+        try:
+            serial.Serial(device).close()
+        except serial.SerialException:
+            logging.info(f'Port {device} is busy')
+            continue
+        addresses.append(device)
+    return addresses
+
+
 def find_address(strict=cfg.args.port_not_strict, test_address=None, ):
     """
     Method to find Certabo Chess port.
@@ -34,7 +34,7 @@ from pathlib import Path
 import sys
 sys.path.append(str(Path(__file__).parent)+"\\certabo")
 
-from utils import reader_writer, usbtool
+from utils import reader_writer, usbtool, led_animation
 import codes
 import certabo
 
@@ -66,115 +66,10 @@ def launch_webbrowser(url):
 
     webbrowser.open(url)
 
-letters = ['a', 'b', 'c', 'd', 'e', 'f', 'g', 'h']
-def get_move_from_fens(fen1, fen2):
-    # this function is used to get the played move from two fens
-    turn = fen1.split(" ")[1] == "w"
-    fen1 = fen1.split(" ")[0]
-    fen2 = fen2.split(" ")[0]
-    index = 0
-    pieces = {}
-    for i in fen1:
-        if i == "/": continue
-        # check if i is a number
-        if i.isdigit():
-            index += int(i)
-            continue
-        index += 1
-        if turn:
-            if i.isupper():
-                try:
-                    pieces[i.lower()].append(index)
-                except:
-                    pieces[i.lower()] = [index]
-        else:
-            if i.islower():
-                try:
-                    pieces[i].append(index)
-                except:
-                    pieces[i] = [index]
-    
-    index = 0
-    to_square = None
-    for i in fen2:
-        if i == "/": continue
-        # check if i is a number
-        if i.isdigit():
-            index += int(i)
-            continue
-        index += 1
-        if turn:
-            if i.isupper():
-                try:
-                    pieces[i.lower()].remove(index)
-                except:
-                    to_square = index
-        else:
-            if i.islower():
-                try:
-                    pieces[i].remove(index)
-                except:
-                    to_square = index
-
-    # if rook and king are the only pieces left in pieces, then it is castling
-    if pieces["k"] != [] and pieces["r"] != []:
-        if pieces["r"] == [8]:
-            # kingside castling
-            return "e8g8"
-        elif pieces["r"] == [1]:
-            # queenside castling
-            return "e8c8"
-        elif pieces["r"] == [64]:
-            # kingside castling
-            return "e1g1"
-        elif pieces["r"] == [57]:
-            # queenside castling
-            return "e1c1"
-
-    # from square is the only non empty list in pieces
-    from_square = [i for i in pieces.values() if len(i) == 1][0][0]
-    # convert to UCI notation
-    from_square = letters[(from_square - 1) % 8] + str((from_square - 1) // 8 + 1)
-    to_square = letters[(to_square - 1) % 8] + str((to_square - 1) // 8 + 1)
-    
-    return from_square + to_square
-
 def flash_leds():
     global mycertabo
-    if mycertabo.board_state_usb == "": return
-
-    board = chess.Board(fen=mycertabo.board_state_usb)
-    # get the indices of the occupied squares, 0 index should be top left square
-    board = board.mirror()
-    occupied_square_indices = [i for i in range(64) if board.piece_at(i) is not None]
-
-    # construct new fen string that contains a pawn if the square is empty and nothing if the square is occupied
-    new_fen = ""
-    empty_index = 0
-    for i in range(64):
-        if i in occupied_square_indices:
-            empty_index += 1
-        else:
-            if empty_index != 0:
-                new_fen += str(empty_index)
-            new_fen += "P"
-            empty_index = 0
-        if i % 8 == 7:
-            if empty_index != 0:
-                new_fen += str(empty_index)
-            new_fen += "/"
-            empty_index = 0
-    new_fen = new_fen[:-1]
-
-    # flash the leds
-    old = mycertabo.chessboard.fen()
-    mycertabo.set_board_from_fen(new_fen)
-    time.sleep(0.5)
-    mycertabo.set_board_from_fen(old)
-    time.sleep(0.5)
-    mycertabo.set_board_from_fen(new_fen)
-    time.sleep(0.5)
-    mycertabo.set_board_from_fen(old)
+    # Game over animation, played by a background thread so the UI keeps running
+    mycertabo.play_animation(led_animation.game_over(rotate180=mycertabo.rotate180))
 
 def connect_to_certabo():
     global mycertabo, led_manager
@@ -768,9 +663,6 @@ class GameScreen(Screen):
                                 padding=[20, 10], on_press=self.new_game))
         
 
-        # start new thread to get move
-        thread = threading.Thread(target=self.get_move, daemon=True)
-        thread.start()
         Clock.schedule_once(self.update_board, 0.1)
 
     def new_game(self, instance):
@@ -785,11 +677,14 @@ class GameScreen(Screen):
     def update_board(self, instance):
         if self.manager.current != 'game': return
         
+        if self.move is None:
+            # poll the moves detected by the board
+            self.move = mycertabo.get_user_move(timeout=0) or None
         if self.move is None:
             Clock.schedule_once(self.update_board, 0.1)
             return
         
-        mycertabo.chessboard.push_uci(self.move[0])
+        mycertabo.play_user_move(self.move[0])
         self.layout.remove_widget(self.layout.children[2])
         self.layout.add_widget(widget=board_to_image(mycertabo.chessboard), index=2)
         self.node = self.node.add_variation(chess.Move.from_uci(self.move[0]))
@@ -798,16 +693,8 @@ class GameScreen(Screen):
         if mycertabo.chessboard.is_game_over():
             flash_leds()
 
-        # start new thread to get move
-        thread = threading.Thread(target=self.get_move, daemon=True)
-        thread.start()
-
         Clock.schedule_once(self.update_board, 0.1)
 
-    # non blocking thread function to get move
-    def get_move(self):
-        self.move = mycertabo.get_user_move()
-    
     def import_game(self, instance):
         pgn = self.game.accept(chess.pgn.StringExporter(headers=True, variations=False, comments=False))
 
@@ -1073,10 +960,10 @@ class OpeningExplorerScreen(Screen):
                                 padding=[20, 10], on_press=self.back))
             
             if self.orientation == 'white' and mycertabo.chessboard.turn == chess.BLACK:
-                mycertabo.chessboard.push(self.node.move)
+                mycertabo.push_move(self.node.move)
                 self.node = self.node.variations[0]
             elif self.orientation == 'black' and mycertabo.chessboard.turn == chess.WHITE:
-                mycertabo.chessboard.push(self.node.move)
+                mycertabo.push_move(self.node.move)
                 self.node = self.node.variations[0]
             
             # add board
@@ -1110,14 +997,10 @@ class OpeningExplorerScreen(Screen):
             # refresh dropdown
             self.refresh_dropdown()
 
-            # start new thread to get move
-            thread = threading.Thread(target=self.get_move, daemon=True)
-            thread.start()
-
             Clock.schedule_once(self.update_board, 0.1)
 
     def play_correct(self, instance):
-        try: mycertabo.chessboard.push(self.node.move)
+        try: mycertabo.push_move(self.node.move)
         except: return
         
         self.layout.remove_widget(self.layout.children[0])
@@ -1145,10 +1028,10 @@ class OpeningExplorerScreen(Screen):
             # pick a random move
             move = random.choice(moves)
             self.node = self.node.variations[move[0]]
-            mycertabo.chessboard.push(self.node.move)
+            mycertabo.push_move(self.node.move)
         else:
             self.node = self.node.variations[0]
-            mycertabo.chessboard.push(self.node.move)
+            mycertabo.push_move(self.node.move)
 
         self.layout.remove_widget(self.layout.children[2])
         self.layout.add_widget(widget=board_to_image(mycertabo.chessboard, flipped=(self.orientation == 'black')), index=2)
@@ -1160,8 +1043,6 @@ class OpeningExplorerScreen(Screen):
             self.layout.add_widget(Label(text="End of Study", font_size=30, size_hint=(1, None), height=50))
             return
 
-        thread = threading.Thread(target=self.get_move, daemon=True)
-        thread.start()
         Clock.schedule_once(self.update_board, 0.1)
 
     def new(self, instance):
@@ -1193,14 +1074,18 @@ class OpeningExplorerScreen(Screen):
         self.layout.add_widget(Label(text="Make the next move", font_size=30, size_hint=(1, None), height=50))
 
         if self.orientation == 'white' and mycertabo.chessboard.turn == chess.BLACK:
-            mycertabo.chessboard.push(self.node.move)
+            mycertabo.push_move(self.node.move)
         elif self.orientation == 'black' and mycertabo.chessboard.turn == chess.WHITE:
-            mycertabo.chessboard.push(self.node.move)
+            mycertabo.push_move(self.node.move)
 
 
     def update_board(self, instance):
         if self.manager.current != 'opening_explorer': return
                 
+        if self.move is None:
+            # poll the moves detected by the board
+            moves = mycertabo.get_user_move(timeout=0)
+            self.move = moves[0] if moves else None
         if self.move is None:
             Clock.schedule_once(self.update_board, 0.1)
             return
@@ -1209,9 +1094,10 @@ class OpeningExplorerScreen(Screen):
             self.layout.remove_widget(self.layout.children[0])
             # add text saying wrong move
             self.layout.add_widget(Label(text="Wrong Move", font_size=30, size_hint=(1, None), height=50, color=(1, 0, 0, 1)))
+            mycertabo.play_user_move()
             self.move = None
         else:
-            mycertabo.chessboard.push(self.node.move)
+            mycertabo.play_user_move(self.node.move)
             self.layout.remove_widget(self.layout.children[0])
             self.layout.add_widget(Label(text="Correct! Make the next move", font_size=30, size_hint=(1, None), height=50, color=(0, 1, 0, 1)))
             self.move = None
@@ -1237,10 +1123,10 @@ class OpeningExplorerScreen(Screen):
                 # pick a random move
                 move = random.choice(moves)
                 self.node = self.node.variations[move[0]]
-                mycertabo.chessboard.push(self.node.move)
+                mycertabo.push_move(self.node.move)
             else:
                 self.node = self.node.variations[0]
-                mycertabo.chessboard.push(self.node.move)
+                mycertabo.push_move(self.node.move)
 
             self.layout.remove_widget(self.layout.children[2])
             self.layout.add_widget(widget=board_to_image(mycertabo.chessboard, flipped=(self.orientation == 'black')), index=2)
@@ -1252,13 +1138,8 @@ class OpeningExplorerScreen(Screen):
                 self.layout.add_widget(Label(text="End of Study", font_size=30, size_hint=(1, None), height=50))
                 return
 
-        thread = threading.Thread(target=self.get_move, daemon=True)
-        thread.start()
         Clock.schedule_once(self.update_board, 0.1)
 
-    def get_move(self):
-        self.move = mycertabo.get_user_move()[0]
-
 class WaitingForBoardScreen(Screen):
     def __init__(self, **kwargs):
         super(WaitingForBoardScreen, self).__init__(**kwargs)
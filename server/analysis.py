@@ -0,0 +1,48 @@
+import io
+
+import chess
+import chess.engine
+import chess.pgn
+
+# shared by the Flask server and the async server
+MAX_ANALYZE_POSITIONS = 500
+MAX_ANALYZE_TIME = 5
+
+
+def parse_limit(limit):
+    # e.g. {"time": 0.5} or {"depth": 12}, searches are capped at MAX_ANALYZE_TIME seconds
+    limit = limit or {"time": 0.1}
+    return chess.engine.Limit(time=min(float(limit.get("time", MAX_ANALYZE_TIME)), MAX_ANALYZE_TIME),
+                              depth=int(limit["depth"]) if "depth" in limit else None,
+                              nodes=int(limit["nodes"]) if "nodes" in limit else None)
+
+
+def parse_positions(data):
+    # a list of FENs, or every position of a PGN (starting position included)
+    if "pgn" in data:
+        game = chess.pgn.read_game(io.StringIO(data["pgn"]))
+        if game is None:
+            raise ValueError("invalid PGN")
+        board = game.board()
+        boards = [board.copy()]
+        for move in game.mainline_moves():
+            board.push(move)
+            boards.append(board.copy())
+        return boards
+    return [chess.Board(fen) for fen in data["fens"]]
+
+
+def result(index, board, info):
+    score = info.get("score")
+    pv = info.get("pv") or [None]
+    return {
+        "index": index,
+        "fen": board.fen(),
+        "move": pv[0].uci() if pv[0] else None,
+        "score": None if score is None else {"cp": score.white().score(), "mate": score.white().mate()},
+        "pv": [move.uci() for move in pv if move],
+    }
+
+
+def error(index, board, message):
+    return {"index": index, "fen": board.fen(), "error": message}
@@ -0,0 +1,349 @@
+"""
+asyncio version of the server (python main.py --async), with the same endpoints as the Flask app.
+
+Engines are driven through the async API of python-chess, so a search in progress doesn't hold a thread,
+and a search is cancelled as soon as its client disconnects. Every response closes the connection.
+"""
+import asyncio
+import json
+import logging
+import os
+import time
+from collections import Counter, namedtuple
+from http import HTTPStatus
+from urllib.parse import parse_qs, urlsplit
+
+import chess
+import chess.engine
+
+import analysis
+from engine_pool import EngineUnavailable
+
+MAX_BODY_SIZE = 1024 * 1024
+MOVE_LIMIT = chess.engine.Limit(time=0.1)
+
+PooledEngine = namedtuple("PooledEngine", ("transport", "engine", "generation"))
+Request = namedtuple("Request", ("method", "path", "query", "headers", "body"))
+
+
+class ClientDisconnected(Exception):
+    pass
+
+
+class AsyncEnginePool:
+    """
+    Same as engine_pool.EnginePool, for asyncio. Switching engines waits (up to drain_timeout seconds)
+    for the searches still running on the old engine, so once set_engine returns only the new engine is used.
+    """
+
+    def __init__(self, path, size=None, timeout=10, drain_timeout=30):
+        self.path = path
+        self.size = size or os.cpu_count() or 1
+        self.timeout = timeout
+        self.drain_timeout = drain_timeout
+        self.idle = asyncio.LifoQueue()
+        self.started = 0
+        self.generation = 0
+        self.busy = Counter()  # generation -> engines checked out
+        self.returned = asyncio.Condition()
+        self.swap_lock = asyncio.Lock()
+        self.restarts = 0
+
+    async def start_engine(self, path, generation):
+        transport, engine = await chess.engine.popen_uci(path)
+        logging.info(f"started engine {path}")
+        return PooledEngine(transport, engine, generation)
+
+    async def close_engine(self, pooled):
+        try:
+            await asyncio.wait_for(pooled.engine.quit(), 5)
+        except Exception:
+            pooled.transport.close()
+
+    async def discard(self, pooled):
+        self.started -= 1
+        await self.close_engine(pooled)
+
+    async def checkout(self, timeout=None):
+        timeout = self.timeout if timeout is None else timeout
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                pooled = self.idle.get_nowait()
+            except asyncio.QueueEmpty:
+                if self.started < self.size:
+                    self.started += 1
+                    try:
+                        pooled = await self.start_engine(self.path, self.generation)
+                    except BaseException:
+                        self.started -= 1
+                        raise
+                    self.busy[pooled.generation] += 1
+                    return pooled
+                try:
+                    pooled = await asyncio.wait_for(self.idle.get(), max(0, deadline - time.monotonic()))
+                except asyncio.TimeoutError:
+                    raise EngineUnavailable(f"no engine available after {timeout}s")
+
+            if pooled.generation != self.generation:
+                await self.discard(pooled)
+                continue
+            if pooled.engine.returncode.done():
+                logging.warning("engine process exited, restarting it")
+                self.restarts += 1
+                await self.discard(pooled)
+                continue
+            self.busy[pooled.generation] += 1
+            return pooled
+
+    async def checkin(self, pooled, healthy=True):
+        self.busy[pooled.generation] -= 1
+        if healthy and pooled.generation == self.generation:
+            self.idle.put_nowait(pooled)
+        else:
+            await self.discard(pooled)
+        async with self.returned:
+            self.returned.notify_all()
+
+    async def run(self, command, timeout=None):
+        """
+        Runs command(engine) on a free engine. If the caller is cancelled, the engine stops searching
+        and goes back to the pool.
+        """
+        pooled = await self.checkout(timeout)
+        healthy = True
+        try:
+            return await command(pooled.engine)
+        except (chess.engine.EngineError, chess.engine.EngineTerminatedError):
+            healthy = False
+            raise
+        finally:
+            await asyncio.shield(self.checkin(pooled, healthy))
+
+    async def play(self, board, limit, timeout=None):
+        return await self.run(lambda engine: engine.play(board, limit), timeout)
+
+    async def analyse(self, board, limit, timeout=None):
+        return await self.run(lambda engine: engine.analyse(board, limit), timeout)
+
+    async def set_engine(self, path):
+        """
+        Raises FileNotFoundError if the engine does not exist
+        """
+        async with self.swap_lock:
+            pooled = await self.start_engine(path, self.generation + 1)
+            old_generation = self.generation
+            self.path = path
+            self.generation += 1
+            self.started += 1
+            while not self.idle.empty():
+                await self.discard(self.idle.get_nowait())
+            self.idle.put_nowait(pooled)
+
+            # searches on older engines finish undisturbed, their engines are closed when returned
+            async with self.returned:
+                drained = lambda: all(count == 0 for generation, count in self.busy.items()
+                                      if generation <= old_generation)
+                try:
+                    await asyncio.wait_for(self.returned.wait_for(drained), self.drain_timeout)
+                except asyncio.TimeoutError:
+                    logging.warning(f"old engine still busy after {self.drain_timeout}s")
+
+    def stats(self):
+        return {"engine": os.path.basename(self.path), "size": self.size, "started": self.started,
+                "idle": self.idle.qsize(), "busy": sum(self.busy.values()), "restarts": self.restarts}
+
+    async def close(self):
+        self.generation += 1
+        while not self.idle.empty():
+            await self.discard(self.idle.get_nowait())
+
+
+async def read_request(reader):
+    request_line = await reader.readline()
+    method, target, _ = request_line.decode("latin-1").split(" ", 2)
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+    length = int(headers.get("content-length", 0))
+    if length > MAX_BODY_SIZE:
+        raise ValueError("request body too large")
+    body = await reader.readexactly(length) if length else b""
+    url = urlsplit(target)
+    query = {name: values[0] for name, values in parse_qs(url.query).items()}
+    return Request(method.upper(), url.path, query, headers, body)
+
+
+async def send(writer, status, body="", content_type="text/html; charset=utf-8"):
+    if isinstance(body, (dict, list)):
+        body, content_type = json.dumps(body), "application/json"
+    body = body.encode("utf-8")
+    status = HTTPStatus(status)
+    writer.write(f"HTTP/1.1 {status.value} {status.phrase}\r\nContent-Type: {content_type}\r\n"
+                 f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode("latin-1") + body)
+    await writer.drain()
+
+
+async def until_disconnect(reader, *tasks):
+    """
+    Yields the tasks as they complete, cancelling the remaining ones if the client disconnects
+    """
+    pending = set(tasks)
+    watch = asyncio.ensure_future(reader.read(1))
+    try:
+        while pending:
+            waiting = pending | {watch} if watch is not None else pending
+            done, _ = await asyncio.wait(waiting, return_when=asyncio.FIRST_COMPLETED)
+            if watch in done:
+                if not watch.result():
+                    raise ClientDisconnected()
+                watch = None  # unexpected data, keep going without watching
+            for task in done - {watch}:
+                pending.discard(task)
+                yield task
+    finally:
+        if watch is not None:
+            watch.cancel()
+        for task in pending:
+            task.cancel()
+
+
+class Server:
+    def __init__(self, engines_dir, engine_name, cache):
+        self.engines_dir = engines_dir
+        self.pool = AsyncEnginePool(os.path.join(engines_dir, engine_name))
+        self.cache = cache
+
+    async def handle(self, reader, writer):
+        try:
+            try:
+                request = await read_request(reader)
+            except (ValueError, asyncio.IncompleteReadError):
+                await send(writer, 400, "Bad request")
+                return
+            route = {
+                ("GET", "/"): self.index,
+                ("GET", "/move"): self.move,
+                ("GET", "/engines"): self.engines,
+                ("GET", "/set_engine"): self.set_engine,
+                ("GET", "/status"): self.status,
+                ("POST", "/analyze"): self.analyze,
+            }.get((request.method, request.path))
+            if route is None:
+                await send(writer, 404, "Not found")
+                return
+            await route(request, reader, writer)
+        except (ClientDisconnected, ConnectionError):
+            pass
+        except Exception:
+            logging.exception("request failed")
+        finally:
+            writer.close()
+
+    async def index(self, request, reader, writer):
+        await send(writer, 200, "Server is running")
+
+    async def move(self, request, reader, writer):
+        fen = request.query.get("fen")
+        if fen is None:
+            await send(writer, 200, "Please enter a FEN")
+            return
+        try:
+            board = chess.Board(fen)
+        except ValueError:
+            await send(writer, 200, "Invalid FEN")
+            return
+        engine_name = os.path.basename(self.pool.path)
+        move = self.cache.get(board, engine_name, MOVE_LIMIT)
+        if move is None:
+            search = asyncio.ensure_future(self.pool.play(board, MOVE_LIMIT))
+            try:
+                async for task in until_disconnect(reader, search):
+                    move = task.result().move.uci()
+            except EngineUnavailable:
+                await send(writer, 503, "Server busy")
+                return
+            except chess.engine.EngineError:
+                await send(writer, 200, "Invalid FEN")
+                return
+            finally:
+                search.cancel()
+            self.cache.put(board, engine_name, MOVE_LIMIT, move)
+        await send(writer, 200, move)
+
+    async def engines(self, request, reader, writer):
+        engines = [engine for engine in os.listdir(self.engines_dir) if engine.endswith(".exe")]
+        await send(writer, 200, str(engines))
+
+    async def set_engine(self, request, reader, writer):
+        name = request.query.get("name")
+        if name is None:
+            await send(writer, 200, "Please enter a name")
+            return
+        try:
+            await self.pool.set_engine(os.path.join(self.engines_dir, name))
+        except FileNotFoundError:
+            await send(writer, 200, "Engine not found")
+            return
+        await send(writer, 200, "Engine set")
+
+    async def status(self, request, reader, writer):
+        await send(writer, 200, {**self.pool.stats(), "cache": self.cache.stats()})
+
+    async def analyze(self, request, reader, writer):
+        try:
+            data = json.loads(request.body)
+            if not isinstance(data, dict) or ("fens" not in data and "pgn" not in data):
+                await send(writer, 400, {"error": "Please send a JSON object with fens or pgn"})
+                return
+            boards = analysis.parse_positions(data)
+            limit = analysis.parse_limit(data.get("limit"))
+        except (ValueError, TypeError, AttributeError) as e:
+            await send(writer, 400, {"error": f"Invalid request: {e}"})
+            return
+        if len(boards) > analysis.MAX_ANALYZE_POSITIONS:
+            await send(writer, 400, {"error": f"At most {analysis.MAX_ANALYZE_POSITIONS} positions per request"})
+            return
+
+        async def analyze_position(index, board):
+            try:
+                return analysis.result(index, board, await self.pool.analyse(board, limit))
+            except EngineUnavailable:
+                return analysis.error(index, board, "server busy")
+            except chess.engine.EngineError as e:
+                return analysis.error(index, board, str(e))
+
+        writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: application/x-ndjson\r\nConnection: close\r\n\r\n")
+        searches = [asyncio.ensure_future(analyze_position(index, board)) for index, board in enumerate(boards)]
+        try:
+            async for task in until_disconnect(reader, *searches):
+                writer.write(json.dumps(task.result()).encode("utf-8") + b"\n")
+                await writer.drain()
+        finally:
+            # also when writing fails, don't search positions nobody will read
+            for search in searches:
+                search.cancel()
+
+    async def serve(self, host, port):
+        server = await asyncio.start_server(self.handle, host, port)
+        logging.info(f"async server listening on {host}:{port}")
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            await self.pool.close()
+
+
+async def serve(engines_dir, engine_name, cache, port, host):
+    await Server(engines_dir, engine_name, cache).serve(host, port)
+
+
+def run(engines_dir, engine_name, cache, port=5000, host="0.0.0.0"):
+    try:
+        asyncio.run(serve(engines_dir, engine_name, cache, port, host))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,156 @@
+import logging
+import os
+import queue
+import threading
+import time
+from contextlib import contextmanager
+
+import chess.engine
+
+
+class EngineUnavailable(Exception):
+    pass
+
+
+class EnginePool:
+    """
+    A pool of engine processes, so concurrent requests each search with their own engine.
+
+    Engines are started on demand up to size (one per core by default). A request waits up to timeout
+    seconds for a free engine. An engine that crashed, or does not answer a ping after being idle, is
+    closed and replaced by a fresh one.
+    """
+
+    def __init__(self, path, size=None, timeout=10, health_check_interval=30):
+        self.path = path
+        self.size = size or os.cpu_count() or 1
+        self.timeout = timeout
+        self.health_check_interval = health_check_interval
+        self.idle = queue.LifoQueue()  # (engine, generation, last used), the most recently used engine first
+        self.lock = threading.Lock()
+        self.started = 0
+        self.generation = 0
+        self.restarts = 0
+
+    def start_engine(self, path):
+        engine = chess.engine.SimpleEngine.popen_uci(path)
+        logging.info(f"started engine {path}")
+        return engine
+
+    def close_engine(self, engine):
+        try:
+            engine.quit()
+        except Exception:
+            try:
+                engine.close()
+            except Exception:
+                pass
+
+    def checkout(self, timeout=None):
+        """
+        Returns a free engine, raises EngineUnavailable if none gets free within timeout seconds
+        """
+        timeout = self.timeout if timeout is None else timeout
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                engine, generation, last_used = self.idle.get_nowait()
+            except queue.Empty:
+                with self.lock:
+                    if self.started < self.size:
+                        self.started += 1
+                        path, generation = self.path, self.generation
+                    else:
+                        path = None
+                if path is not None:
+                    try:
+                        return self.start_engine(path), generation
+                    except Exception:
+                        with self.lock:
+                            self.started -= 1
+                        raise
+                try:
+                    engine, generation, last_used = self.idle.get(timeout=max(0, deadline - time.monotonic()))
+                except queue.Empty:
+                    raise EngineUnavailable(f"no engine available after {timeout}s")
+
+            if generation != self.generation or not self.is_healthy(engine, last_used):
+                self.discard(engine)
+                continue
+            return engine, generation
+
+    def checkin(self, engine, generation, healthy=True):
+        if healthy and generation == self.generation:
+            self.idle.put((engine, generation, time.monotonic()))
+        else:
+            self.discard(engine)
+
+    def discard(self, engine):
+        with self.lock:
+            self.started -= 1
+        self.close_engine(engine)
+
+    def is_healthy(self, engine, last_used):
+        if engine.protocol.returncode.done():
+            logging.warning("engine process exited, restarting it")
+            self.restarts += 1
+            return False
+        if time.monotonic() - last_used > self.health_check_interval:
+            try:
+                engine.ping()
+            except Exception as e:
+                logging.warning(f"engine does not answer ({e}), restarting it")
+                self.restarts += 1
+                return False
+        return True
+
+    @contextmanager
+    def engine(self, timeout=None):
+        engine, generation = self.checkout(timeout)
+        healthy = True
+        try:
+            yield engine
+        except (chess.engine.EngineError, chess.engine.EngineTerminatedError, TimeoutError):
+            healthy = False
+            raise
+        finally:
+            self.checkin(engine, generation, healthy)
+
+    def play(self, board, limit, timeout=None):
+        with self.engine(timeout) as engine:
+            return engine.play(board, limit)
+
+    def analyse(self, board, limit, timeout=None):
+        with self.engine(timeout) as engine:
+            return engine.analyse(board, limit)
+
+    def set_engine(self, path):
+        """
+        Switches every engine of the pool to path. Searches in progress finish with the old engine,
+        which is closed when it is returned. Raises FileNotFoundError if the engine does not exist.
+        """
+        engine = self.start_engine(path)
+        with self.lock:
+            self.path = path
+            self.generation += 1
+            generation = self.generation
+            self.started += 1
+        self.close_idle()
+        self.checkin(engine, generation)
+
+    def close_idle(self):
+        while True:
+            try:
+                engine, _, _ = self.idle.get_nowait()
+            except queue.Empty:
+                return
+            self.discard(engine)
+
+    def stats(self):
+        return {"engine": os.path.basename(self.path), "size": self.size, "started": self.started,
+                "idle": self.idle.qsize(), "restarts": self.restarts}
+
+    def close(self):
+        with self.lock:
+            self.generation += 1
+        self.close_idle()
@@ -1,9 +1,18 @@
+import atexit
+import json
 import logging
-from flask import Flask, request
+import sys
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from flask import Flask, request, Response
 import chess.engine
 import chess
 import os
 
+import analysis
+
+from engine_pool import EnginePool, EngineUnavailable
+from move_cache import MoveCache
+
 app = Flask(__name__)
 
 # initialize the engine when the server starts up, please change this to your own engine path
@@ -12,7 +21,15 @@ engines = [engine for engine in engines if engine.endswith(".exe")]
 if len(engines) == 0:
     raise Exception("No engines found in engines folder")
 
-engine = chess.engine.SimpleEngine.popen_uci(f"engines/{engines[0]}")
+# one engine per core, started when needed, so concurrent requests don't wait on each other
+pool = EnginePool(f"engines/{engines[0]}")
+
+# best moves of positions already searched, kept across restarts
+cache = MoveCache(path="move_cache.json")
+atexit.register(cache.save)
+
+# positions of /analyze batches are searched in parallel, one per engine of the pool
+executor = ThreadPoolExecutor(max_workers=pool.size)
 
 
 # define a custom logging filter that silences logs for the /move endpoint since it can get quite noisy
@@ -39,12 +56,59 @@ def get_best_move():
     if fen is None:
         return "Please enter a FEN"
     board = chess.Board(fen)
+    limit = chess.engine.Limit(time=0.1)
+    engine_name = os.path.basename(pool.path)
+    move = cache.get(board, engine_name, limit)
+    if move is not None:
+        return move
     try:
-        result = engine.play(board, chess.engine.Limit(time=0.1))
+        result = pool.play(board, limit)
+        cache.put(board, engine_name, limit, result.move.uci())
         return result.move.uci()
+    except EngineUnavailable:
+        return "Server busy", 503
     except:
         return "Invalid FEN"
     
+def analyze_position(index, board, limit):
+    try:
+        info = pool.analyse(board, limit)
+    except EngineUnavailable:
+        return analysis.error(index, board, "server busy")
+    except TimeoutError:
+        # the pool restarts the engine, the other positions go on
+        return analysis.error(index, board, "engine timed out")
+    except chess.engine.EngineError as e:
+        return analysis.error(index, board, str(e))
+    return analysis.result(index, board, info)
+
+@app.route('/analyze', methods=['POST'])
+def analyze():
+    # body: {"fens": [...]} or {"pgn": "..."}, plus an optional "limit"
+    # every position is answered with a JSON line as soon as its search completes, in any order
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict) or ("fens" not in data and "pgn" not in data):
+        return {"error": "Please send a JSON object with fens or pgn"}, 400
+    try:
+        boards = analysis.parse_positions(data)
+        limit = analysis.parse_limit(data.get("limit"))
+    except (ValueError, TypeError, AttributeError) as e:
+        return {"error": f"Invalid request: {e}"}, 400
+    if len(boards) > analysis.MAX_ANALYZE_POSITIONS:
+        return {"error": f"At most {analysis.MAX_ANALYZE_POSITIONS} positions per request"}, 400
+
+    def generate():
+        futures = [executor.submit(analyze_position, index, board, limit) for index, board in enumerate(boards)]
+        try:
+            for future in as_completed(futures):
+                yield json.dumps(future.result()) + "\n"
+        finally:
+            # the client went away, don't search positions nobody will read
+            for future in futures:
+                future.cancel()
+
+    return Response(generate(), mimetype="application/x-ndjson")
+
 @app.route('/engines')
 def get_engines():
     # list all engines in the engines folder
@@ -56,18 +120,26 @@ def get_engines():
 @app.route('/set_engine')
 def set_engine():
     # switch to a different engine
-    global engine
     name = request.args.get('name')
     if name is None:
         return "Please enter a name"
     
     try:
-        engine = chess.engine.SimpleEngine.popen_uci(f"engines/{name}")
+        pool.set_engine(f"engines/{name}")
     except FileNotFoundError:
         return "Engine not found"
     
     return "Engine set"
 
+@app.route('/status')
+def get_status():
+    return {**pool.stats(), "cache": cache.stats()}
+
 if __name__ == '__main__':
     port = 5000
-    app.run(port=port, host='0.0.0.0')
\ No newline at end of file
+    if "--async" in sys.argv:
+        # asyncio server: searches don't hold a thread each and are cancelled when clients disconnect
+        import async_server
+        async_server.run("engines", engines[0], cache, port=port, host='0.0.0.0')
+    else:
+        app.run(port=port, host='0.0.0.0')
\ No newline at end of file
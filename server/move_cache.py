@@ -0,0 +1,112 @@
+import json
+import logging
+import os
+import sys
+import tempfile
+import threading
+from collections import OrderedDict
+
+
+def position_key(board):
+    """
+    The parts of the FEN that decide the best move: pieces, turn, castling rights and a legal en passant square
+    """
+    return " ".join(board.fen(en_passant="legal").split()[:4])
+
+
+def limit_key(limit):
+    return ",".join(f"{name}={value}" for name, value in sorted(vars(limit).items()) if value is not None)
+
+
+class MoveCache:
+    """
+    Least recently used cache of best moves, keyed by position, engine and search limit.
+
+    Entries are evicted when either max_entries or (roughly) max_bytes is exceeded. If a path is given,
+    the cache is loaded from it on start and written back by save.
+    """
+
+    def __init__(self, max_entries=100000, max_bytes=32 * 1024 * 1024, path=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.path = path
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.dirty = False
+        if path is not None:
+            self.load()
+
+    @staticmethod
+    def entry_size(key, move):
+        return sys.getsizeof(key) + sum(sys.getsizeof(part) for part in key) + sys.getsizeof(move)
+
+    def get(self, board, engine, limit):
+        key = (position_key(board), engine, limit_key(limit))
+        with self.lock:
+            move = self.entries.get(key)
+            if move is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return move
+
+    def put(self, board, engine, limit, move):
+        self.add((position_key(board), engine, limit_key(limit)), move)
+
+    def add(self, key, move):
+        with self.lock:
+            old_move = self.entries.pop(key, None)
+            if old_move is not None:
+                self.bytes -= self.entry_size(key, old_move)
+            self.entries[key] = move
+            self.bytes += self.entry_size(key, move)
+            while self.entries and (len(self.entries) > self.max_entries or self.bytes > self.max_bytes):
+                old_key, old_move = self.entries.popitem(last=False)
+                self.bytes -= self.entry_size(old_key, old_move)
+            self.dirty = True
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.bytes = 0
+            self.dirty = True
+
+    def stats(self):
+        return {"entries": len(self.entries), "bytes": self.bytes, "hits": self.hits, "misses": self.misses}
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path) as f:
+                entries = json.load(f)["entries"]
+            # oldest first, so the least recently used entries are evicted first again
+            for fen, engine, limit, move in entries:
+                self.add((fen, engine, limit), move)
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            logging.warning(f"could not load move cache {self.path}: {e}")
+        self.dirty = False
+        logging.info(f"loaded {len(self.entries)} cached moves from {self.path}")
+
+    def save(self):
+        """
+        Writes the cache to its path, if it has one and anything changed
+        """
+        if self.path is None or not self.dirty:
+            return
+        with self.lock:
+            entries = [[*key, move] for key, move in self.entries.items()]
+            self.dirty = False
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".move_cache-", suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump({"version": 1, "entries": entries}, f)
+            os.replace(tmp_path, self.path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise